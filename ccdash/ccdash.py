@@ -23,30 +23,56 @@ tests and submitting the result to CDash.
 
 # $Id$
 
+# Only the modules needed by every operation, or cheap to import and used in
+# hot paths, are imported here. The others, including the optional pysvn,
+# are imported by the functions which use them, so that e.g. "ccdash.py
+# upload" starts quickly and works without pysvn.
 import base64
+import collections
 import copy
+import errno
+import fnmatch
 import glob
-import gzip
+import hashlib
+import math
 from optparse import OptionParser,OptionGroup
 import os
-import platform
-import random
 import re
 import shutil
-import subprocess
+import signal
 import sys
-import tempfile
-import threading
+import thread
 import time
-import xml.dom
-import xml.dom.minidom
-import pysvn
 
 PROG = "ccdash-0.2 (r" + "$Rev$".strip("$ ").replace("Rev: ", "") + ")"
 
 # Constants
 MAXLOG = -1
 TEST_TIMEOUT = (30 * 60)
+LOG_CHUNK_SIZE = (64 * 1024)
+OUTPUT_DRAIN_TIMEOUT = 5
+KILL_TIMEOUT = 10
+UPLOAD_TIMEOUT = (5 * 60)
+UPLOAD_RETRIES = 3
+UPLOAD_RETRY_DELAY = 5
+SPOOL_DIR = os.path.join(os.path.expanduser("~"), ".ccdash", "spool")
+HISTORY_DB = os.path.join(os.path.expanduser("~"), ".ccdash", "history.db")
+HISTORY_RUNS = 5
+ADAPTIVE_TIMEOUT_RUNS = 20
+ADAPTIVE_TIMEOUT_MIN_RUNS = 5
+ADAPTIVE_TIMEOUT_FACTOR = 3
+ADAPTIVE_TIMEOUT_MIN = 60
+PERF_REGRESSION_RUNS = 3
+PERF_REGRESSION_FACTOR = 2
+PERF_REGRESSION_MIN = 1
+BUILD_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".ccdash", "cache")
+BUILD_CACHE_ENTRIES = 10
+BUILD_CACHE_MARK = ".ccdash-build"
+DRAIN_JOBS = 4
+WATCH_INTERVAL = 60
+WATCH_SETTLE = 120
+WATCH_RETRIES = 2
+PARSE_LOG_CHUNK_SIZE = (1024 * 1024)
 
 class ExecStatus:
     """\
@@ -57,14 +83,18 @@ class ExecStatus:
     output = ""
     errmsg = None
     retcode = 127
-    def __init__(self, cmd, output, errmsg, retcode):
+    timed_out = False
+    def __init__(self, cmd, output, errmsg, retcode, timed_out=False):
         self.cmd = cmd
         self.output = output
         self.errmsg = errmsg
         self.retcode = retcode
+        self.timed_out = timed_out
     def __str__(self):
         if self.errmsg:
             return "Error executing '%s': %s" % (self.cmd, self.errmsg)
+        elif self.timed_out:
+            return "Error executing '%s': program timed out" % (self.cmd)
         elif self.retcode:
             return "Error executing '%s': program returned %d" % \
                     (self.cmd, self.retcode)
@@ -73,28 +103,95 @@ class ExecStatus:
     def error(self):
         """Returns True if the execution has failed
         """
-        return self.errmsg or self.retcode
+        return self.errmsg or self.retcode or self.timed_out
 
 
+class OutputBuffer:
+    """\
+    This class keeps the output of a process, retaining only the part that
+    CCDash.encode_log() will actually submit when the log size is limited
+    with 'max_log': the first 'max_log' bytes, or the last 'max_log' bytes
+    if 'last_log' is set (the latter is kept in a ring of chunks). Memory
+    use is O(max_log) regardless of how much output is written, while
+    len() still returns the total size of the output.
+
+    """
+    def __init__(self, max_log=-1, last_log=True):
+        self.max_log = max_log      # -1: keep everything
+        self.last_log = last_log    # Keep the last rather than first bytes
+        self.size = 0               # Total number of bytes written
+        self.kept = 0               # Number of bytes in self.chunks
+        self.chunks = collections.deque()
+
+    def write(self, s):
+        self.size = self.size + len(s)
+        if self.max_log < 0:
+            pass
+        elif self.last_log:
+            if len(s) >= self.max_log:
+                self.chunks.clear()
+                self.kept = 0
+                s = s[len(s)-self.max_log:]
+        else:
+            s = s[:self.max_log-self.kept]
+        if not s:
+            return
+        self.chunks.append(s)
+        self.kept = self.kept + len(s)
+        if self.max_log >= 0 and self.last_log:
+            # Drop chunks which are no longer within the last N bytes
+            while self.kept - len(self.chunks[0]) >= self.max_log:
+                self.kept = self.kept - len(self.chunks.popleft())
+
+    def getvalue(self):
+        """\
+        Return the retained output as string.
+
+        """
+        s = "".join(self.chunks)
+        self.chunks.clear()
+        if s:
+            self.chunks.append(s)
+        return s
+
+    def __len__(self):
+        return self.size
+
+    def __str__(self):
+        return self.getvalue()
+
+
+# Characters which need escaping in xml_escape(): everything except plain
+# ASCII below chr(127) other than '&', '<', and '>'. Characters at or above
+# chr(127) are sent as numeric character reference.
+_xml_escape_re = re.compile(r"[^\x00-\x25\x27-\x3b\x3d\x3f-\x7e]")
+_xml_escape_tab = {"&": "&amp;", "<": "&lt;", ">": "&gt;"}
+
+def _xml_escape_char(m):
+        c = m.group()
+        try:
+                return _xml_escape_tab[c]
+        except KeyError:
+                return "&#%d;" % (ord(c))
+
 def xml_escape(txt):
-        out = ""
-        for c in txt:
-                if c == '&':
-                        out = out + "&amp;"
-                elif c == '<':
-                        out = out + "&lt;"
-                elif c == '>':
-                        out = out + "&gt;"
-                elif c >= chr(127):
-                        out = out + ( "&#%d;" % (ord(c)) )
-                else:
-                        out = out + c
-        return out
+        """\
+        Escape XML special characters in 'txt'. Text that does not need
+        escaping (the common case) is returned as is without copying,
+        otherwise all escapes are done in one regular expression pass.
+        """
+        if not _xml_escape_re.search(txt):
+                return txt
+        return _xml_escape_re.sub(_xml_escape_char, txt)
 
 class Node:
     """\
     This class provides basic functionality to write XML documents.
 
+    The body is normally a string, but it can also be an object with
+    write_xml(f) method (such as LogBody) which writes the escaped body
+    directly to the output when the document is written.
+
     """
     def __init__(self, tag, attrs=None, body=""):
         self.tag = tag
@@ -107,21 +204,189 @@ class Node:
         self.children.append(child)
 
     def __str__(self):
-        return "<?xml version=\"1.0\" encoding=\"UTF-8\"?>\n" + self._encode()
+        w = _ListWriter()
+        self.write(w)
+        return w.getvalue()
 
     def _encode(self, indent=""):
-        s = indent + "<" + self.tag
+        w = _ListWriter()
+        self._write(w, indent)
+        return w.getvalue()
+
+    def write(self, f):
+        """\
+        Write the XML document (header and the whole node tree) to the file
+        like object 'f' (anything with a write() method, such as an open file
+        or socket.makefile()). The document is written piece by piece while
+        the tree is traversed, so it is never built in memory as a whole.
+
+        """
+        f.write("<?xml version=\"1.0\" encoding=\"UTF-8\"?>\n")
+        self._write(f)
+
+    def _write(self, f, indent=""):
+        f.write(indent + "<" + self.tag)
         for k, v in self.attrs.items():
-            s = s + " %s=\"%s\"" % (k, xml_escape(v) )
-        s = s + ">"
-        if len(self.children): s = s + "\n"
-        for node in self.children:
-            s = s + node._encode(indent + "  ")
-        s = s + xml_escape(self.body)
+            f.write(" %s=\"%s\"" % (k, xml_escape(v) ))
         if len(self.children):
-            s = s + indent
-        s = s + "</" + self.tag + ">\n"
-        return s
+            f.write(">\n")
+            for node in self.children:
+                node._write(f, indent + "  ")
+        else:
+            f.write(">")
+        if hasattr(self.body, "write_xml"):
+            self.body.write_xml(f)
+        else:
+            f.write(xml_escape(self.body))
+        if len(self.children):
+            f.write(indent)
+        f.write("</" + self.tag + ">\n")
+
+
+class _ListWriter:
+    """\
+    Minimal file like object collecting the written chunks in a list, used
+    to serialize Node into a string without repeated concatenation.
+
+    """
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, s):
+        self.chunks.append(s)
+
+    def getvalue(self):
+        return "".join(self.chunks)
+
+
+class _XmlEscapeWriter:
+    """\
+    File like object which escapes the written text with xml_escape()
+    before writing it to the underlying file 'f'.
+
+    """
+    def __init__(self, f):
+        self.f = f
+
+    def write(self, s):
+        self.f.write(xml_escape(s))
+
+
+class _Base64Writer:
+    """\
+    File like object which base64 encodes the written data on the fly and
+    writes the result to the underlying file 'f'. Call close() to write the
+    remaining (partial) block.
+
+    """
+    def __init__(self, f):
+        self.f = f
+        self.pending = ""
+
+    def write(self, data):
+        data = self.pending + data
+        n = len(data) - (len(data) % 3)
+        self.pending = data[n:]
+        if n:
+            self.f.write(base64.b64encode(data[:n]))
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self.pending:
+            self.f.write(base64.b64encode(self.pending))
+            self.pending = ""
+
+
+class LogBody:
+    """\
+    This class represents a log to be submitted as XML body, which is
+    trimmed, compressed, and encoded while it is being written to the
+    output, in chunks of LOG_CHUNK_SIZE bytes. The log is either a string
+    (or OutputBuffer), or a file which is only read when the body is
+    written. Use CCDash.log_body() or CCDash.log_file_body() to create
+    the instance.
+
+    """
+    def __init__(self, log=None, filename=None, encoding="", compression="",
+                 max_log=-1, last_log=True):
+        self.size = 0                   # Original log size
+        if log is not None:
+            self.size = len(log)
+            if isinstance(log, OutputBuffer):
+                log = log.getvalue()
+        self.log = log                  # Log content, or
+        self.filename = filename        # log file name
+        self.encoding = encoding        # Encoding, e.g. "base64"
+        self.compression = compression  # Compression, e.g. "gzip"
+        self.max_log = max_log          # See CCDash.max_log
+        self.last_log = last_log        # See CCDash.last_log
+
+    def _chunks(self):
+        """\
+        Generate the (trimmed) log content in chunks.
+
+        """
+        if self.filename is None:
+            size = self.size
+            end = len(self.log)
+        else:
+            size = end = os.path.getsize(self.filename)
+        start = 0
+        trimmed = self.max_log > 0 and size > self.max_log
+        if trimmed:
+            if self.last_log:
+                yield "(Output trimmed to last " + str(self.max_log) + \
+                      " bytes)\n.."
+                start = end - self.max_log
+            else:
+                end = self.max_log
+        if self.filename is None:
+            while start < end:
+                yield self.log[start:min(start+LOG_CHUNK_SIZE, end)]
+                start = start + LOG_CHUNK_SIZE
+        else:
+            f = open(self.filename, "rb")
+            try:
+                f.seek(start)
+                while start < end:
+                    data = f.read(min(LOG_CHUNK_SIZE, end-start))
+                    if not data:
+                        break
+                    start = start + len(data)
+                    yield data
+            finally:
+                f.close()
+        if trimmed and not self.last_log:
+            yield "..\n" + \
+                  "(Output trimmed to the first " + str(self.max_log) + \
+                  " bytes)\n"
+
+    def write(self, f):
+        """\
+        Write the encoded log to file like object 'f'.
+
+        """
+        import gzip
+
+        out = f
+        b64 = None
+        gz = None
+        if self.encoding.find("base64") >= 0:
+            out = b64 = _Base64Writer(out)
+        if self.compression.find("gzip") >= 0 or \
+           self.compression.find("gz") >= 0:
+            out = gz = gzip.GzipFile(filename="", mode="wb", fileobj=out)
+        for data in self._chunks():
+            out.write(data)
+        if gz:
+            gz.close()
+        if b64:
+            b64.close()
+
+    def write_xml(self, f):
+        self.write(_XmlEscapeWriter(f))
 
 
 class MergedTesting:
@@ -136,6 +401,8 @@ class MergedTesting:
                 self.test_nodes = []
 
         def add_node(self, node):
+                import xml.dom
+
                 if node.nodeName != "Testing":
                         sys.stderr.write("Error: MeregdTesting.add_node() expects <Testing> node\n")
                         return 1
@@ -212,6 +479,721 @@ class MergedTesting:
                 doc.documentElement.appendChild(testing)
 
 
+class _OutputReader:
+    """\
+    Helper for CCDash.exec_cmd() to process the output of a child process
+    line by line as it arrives.
+
+    """
+    def __init__(self, ci, fout, out_write, filter_func):
+        import threading
+
+        self.ci = ci                    # CCDash instance, for tracing
+        self.fout = fout                # Save output to this file, if any
+        self.out_write = out_write      # Function to collect output, if any
+        self.filter_func = filter_func  # Line filter function, if any
+        self.line_num = 0               # Number of lines processed
+        self.stopped = False            # Stop processing further output
+        self.lock = threading.Lock()
+
+    def read_from(self, pipe):
+        for line_str in iter(pipe.readline, ""):
+            self.lock.acquire()
+            try:
+                if self.stopped:
+                    break
+                self._process_line(line_str)
+            finally:
+                self.lock.release()
+        pipe.close()
+
+    def stop(self):
+        """\
+        Discard any output that arrives after this call.
+
+        """
+        self.lock.acquire()
+        self.stopped = True
+        self.lock.release()
+
+    def process_line(self, line_str):
+        self.lock.acquire()
+        try:
+            self._process_line(line_str)
+        finally:
+            self.lock.release()
+
+    def _process_line(self, line_str):
+        if self.fout:
+            self.fout.write(line_str)
+        line_str = line_str.replace("\r", "")
+        self.line_num = self.line_num + 1
+        if self.out_write:
+            self.out_write(line_str)
+        line_str = line_str.rstrip("\r\n")
+        self.ci.trace(2, "   " + line_str)
+        if self.filter_func:
+            self.filter_func(line_str, self.line_num)
+
+
+class HttpUploader:
+    """\
+    This class uploads files with HTTP PUT, like "curl -T" does, but without
+    spawning a process for every upload. The connection to each submit host
+    is kept alive and reused for subsequent uploads, and the file content is
+    streamed from disk rather than read into memory.
+
+    """
+    def __init__(self):
+        self.conns = {}         # (scheme, host, port) vs HTTPConnection
+
+    def _get_conn(self, key):
+        """\
+        Get the connection for the specified key, creating a new one if
+        necessary. Returns (conn, reused) tuple.
+
+        """
+        import httplib
+
+        conn = self.conns.get(key)
+        if conn is not None:
+            return conn, True
+        scheme, host, port = key
+        if scheme == "https":
+            conn = httplib.HTTPSConnection(host, port, timeout=UPLOAD_TIMEOUT)
+        else:
+            conn = httplib.HTTPConnection(host, port, timeout=UPLOAD_TIMEOUT)
+        self.conns[key] = conn
+        return conn, False
+
+    def _drop_conn(self, key):
+        conn = self.conns.pop(key, None)
+        if conn is not None:
+            conn.close()
+
+    def put_file(self, filename, url):
+        """\
+        Send the content of 'filename' to 'url' with HTTP PUT. Returns
+        ExecStatus object, with the response body as the output. A status
+        code other than 2xx is reported as error, with the status code as
+        the return code.
+
+        """
+        import httplib
+        import socket
+        import urlparse
+
+        cmd = "PUT %s %s" % (filename, url)
+        u = urlparse.urlsplit(url)
+        if u.scheme not in ("http", "https"):
+            return ExecStatus(cmd, "", "unsupported URL scheme '%s'" % \
+                              (u.scheme), 127)
+        key = (u.scheme, u.hostname, u.port)
+        path = u.path or "/"
+        if u.query:
+            path = path + "?" + u.query
+        headers = {"User-Agent": PROG}
+        if u.username:
+            auth = u.username + ":" + (u.password or "")
+            headers["Authorization"] = "Basic " + base64.b64encode(auth)
+
+        try:
+            f = open(filename, "rb")
+        except IOError, e:
+            return ExecStatus(cmd, "", str(e), 127)
+        try:
+            headers["Content-Length"] = str(os.fstat(f.fileno()).st_size)
+            while True:
+                conn, reused = self._get_conn(key)
+                try:
+                    conn.request("PUT", path, f, headers)
+                    resp = conn.getresponse()
+                    body = resp.read()
+                    break
+                except (httplib.HTTPException, socket.error), e:
+                    self._drop_conn(key)
+                    if not reused:
+                        return ExecStatus(cmd, "", str(e), 127)
+                    # The server may have closed the idle connection in
+                    # the meantime, so try again with a new one.
+                    f.seek(0)
+        finally:
+            f.close()
+
+        if resp.status < 200 or resp.status >= 300:
+            return ExecStatus(cmd, body, "HTTP error %d %s" % \
+                              (resp.status, resp.reason), resp.status)
+        return ExecStatus(cmd, body, None, 0)
+
+    def close(self):
+        for key in self.conns.keys():
+            self._drop_conn(key)
+
+
+def _upload_temporary_error(ret):
+    """\
+    Tell if the failed upload (ExecStatus of HttpUploader.put_file()) may
+    succeed if it is tried again later: connection errors, timeouts, and
+    server errors. Other HTTP errors mean that the file has been rejected.
+
+    """
+    return ret.retcode in (127, 408, 429) or ret.retcode >= 500
+
+
+class UploadQueue:
+    """\
+    This class uploads files in the background with a worker thread, in the
+    order they are queued, so that a submission can be sent while the next
+    operation is running.
+
+    CDash expects the Build submission to come first, so if 'hold' is True,
+    files queued with put() are held back until a file is queued with
+    put_first(). Files which could not be uploaded are put in the spool
+    (see CCDash.submit_file()), and returned by finish(). Files which have
+    been rejected by the server are kept in 'rejected'. Each file which
+    has been sent, spooled, or rejected is recorded in the 'journal' if
+    specified.
+
+    """
+    def __init__(self, ci, hold=False, journal=None):
+        import Queue
+        import threading
+
+        self.ci = ci                    # CCDash instance
+        self.hold = hold                # Hold files until put_first()
+        self.journal = journal          # Journal, if any
+        self.held = []                  # Files being held
+        self.spooled = []               # Files which are put in the spool
+        self.rejected = []              # Files rejected by the server
+        self.queue = Queue.Queue()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            fname = self.queue.get()
+            if fname is None:
+                break
+            ret = self.ci.submit_file(fname)
+            if ret is None:
+                self.spooled.append(fname)
+            elif ret.error():
+                self.rejected.append(fname)
+            if self.journal:
+                self.journal.add_sent(fname)
+
+    def put(self, fname):
+        if self.hold:
+            self.held.append(fname)
+        else:
+            self.queue.put(fname)
+
+    def put_first(self, fname):
+        """\
+        Queue the file, followed by the files which have been held back.
+
+        """
+        self.queue.put(fname)
+        for f in self.held:
+            self.queue.put(f)
+        self.held = []
+        self.hold = False
+
+    def finish(self):
+        """\
+        Send the remaining files (including the held ones), wait until all
+        uploads are done, and return the list of files which have been put
+        in the spool.
+
+        """
+        for f in self.held:
+            self.queue.put(f)
+        self.held = []
+        self.queue.put(None)
+        self.thread.join()
+        return self.spooled
+
+
+class Spool:
+    """\
+    This class manages the spool directory, where submissions which could
+    not be uploaded are kept until they are sent with "ccdash.py drain".
+
+    The spool has a subdirectory for each batch of submissions (i.e. the
+    build stamp), containing the XML files numbered in the order they must
+    be sent, each accompanied by ".url" file containing the submit URL.
+
+    """
+    # Submissions running at the same time may add to the same batch.
+    # The same lock as threading.Lock(), without importing threading.
+    _lock = thread.allocate_lock()
+
+    def __init__(self, ci, dirname):
+        self.ci = ci                    # CCDash instance
+        self.dirname = dirname          # Spool directory
+
+    def _batch_dir(self, batch):
+        return os.path.join(self.dirname, batch or "nostamp")
+
+    def batches(self):
+        if not os.path.isdir(self.dirname):
+            return []
+        names = [n for n in os.listdir(self.dirname)
+                     if os.path.isdir(os.path.join(self.dirname, n))]
+        names.sort()
+        return names
+
+    def files(self, batch):
+        """\
+        Get the files of the batch, in the order they must be sent.
+
+        """
+        bdir = self._batch_dir(batch)
+        if not os.path.isdir(bdir):
+            return []
+        names = [n for n in os.listdir(bdir) if n.endswith(".xml")]
+        names.sort()
+        return [os.path.join(bdir, n) for n in names]
+
+    def has_batch(self, batch):
+        return len(self.files(batch)) > 0
+
+    def add(self, batch, filename, url):
+        """\
+        Copy the file to the spool, as the last file of the batch.
+
+        """
+        bdir = self._batch_dir(batch)
+        name = os.path.splitext(os.path.basename(filename))[0]
+        Spool._lock.acquire()
+        try:
+            if not os.path.isdir(bdir):
+                os.makedirs(bdir)
+            files = self.files(batch)
+            if files:
+                idx = int(os.path.basename(files[-1])[:4]) + 1
+            else:
+                idx = 1
+            dst = os.path.join(bdir, "%04d-%s.xml" % (idx, name))
+            f = open(dst + ".url", "w")
+            f.write(url)
+            f.close()
+            # The file is only picked up once it has been completely copied
+            shutil.copyfile(filename, dst + ".tmp")
+            os.rename(dst + ".tmp", dst)
+        finally:
+            Spool._lock.release()
+        self.ci.trace(-1, "  '%s' is added to the spool as '%s'" % \
+                          (filename, dst))
+
+    def _drain_batch(self, batch, uploader):
+        ok = True
+        for fname in self.files(batch):
+            f = open(fname + ".url", "r")
+            url = f.read().strip()
+            f.close()
+            ret = self.ci.upload_file(fname, url, uploader)
+            if ret.output:
+                self.ci.trace(2, "   " + ret.output)
+            if ret.error():
+                self.ci.trace(-1, "  " + str(ret))
+                if _upload_temporary_error(ret):
+                    return False
+                # Sending it again won't help, so move it out of the batch
+                # and continue with the rest
+                os.rename(fname, fname + ".rejected")
+                os.rename(fname + ".url", fname + ".rejected.url")
+                self.ci.trace(-1, "  '%s' has been rejected, it is kept " \
+                                  "as '%s'" % (fname, fname + ".rejected"))
+                ok = False
+                continue
+            os.remove(fname)
+            os.remove(fname + ".url")
+        try:
+            os.rmdir(self._batch_dir(batch))
+        except OSError:
+            pass
+        return ok
+
+    def _drain_worker(self, batches, failed):
+        import Queue
+
+        uploader = HttpUploader()
+        while True:
+            try:
+                batch = batches.get_nowait()
+            except Queue.Empty:
+                break
+            if not self._drain_batch(batch, uploader):
+                failed.append(batch)
+        uploader.close()
+
+    def drain(self, jobs=DRAIN_JOBS):
+        """\
+        Upload the files in the spool, sending up to 'jobs' batches at the
+        same time. The files of a batch are sent one by one, in order, and
+        if one of them fails, it and the rest of the batch stay in the
+        spool. A file rejected by the server is renamed with ".rejected"
+        suffix, together with its ".url" file, so it is not sent again.
+        Returns the number of batches which are not sent completely.
+
+        """
+        import Queue
+        import threading
+
+        batches = Queue.Queue()
+        for batch in self.batches():
+            batches.put(batch)
+        failed = []
+        threads = []
+        for i in range(jobs):
+            t = threading.Thread(target=self._drain_worker,
+                                 args=(batches, failed))
+            t.start()
+            threads.append(t)
+        for t in threads:
+            t.join()
+        return len(failed)
+
+
+class History:
+    """\
+    This class keeps the history of test results in local SQLite database,
+    to be used for scheduling the tests, adaptive timeouts, and detecting
+    performance regressions. Each run of a test item is recorded
+    with its start time, duration, and exit value, per site and build name.
+
+    The history is only an aid, so database errors are reported as warning
+    and otherwise ignored.
+
+    """
+    def __init__(self, ci, filename):
+        self.ci = ci                    # CCDash instance
+        self.filename = filename        # Database file
+        self.db = None
+
+    def _open(self):
+        import sqlite3
+
+        if self.db is None:
+            dirname = os.path.dirname(self.filename)
+            if dirname and not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            self.db = sqlite3.connect(self.filename)
+            self.db.execute("CREATE TABLE IF NOT EXISTS test_runs (" \
+                            "site TEXT, build TEXT, name TEXT, " \
+                            "start REAL, duration REAL, " \
+                            "exit_value TEXT, success INTEGER)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS test_runs_idx " \
+                            "ON test_runs (site, build, name, start)")
+        return self.db
+
+    def _error(self, e):
+        self.ci.trace(-1, "  Warning: test history '%s': %s" % \
+                          (self.filename, str(e)))
+
+    def record(self, items):
+        """\
+        Record the result of the executed TestItem's.
+
+        """
+        import sqlite3
+
+        try:
+            db = self._open()
+            for t in items:
+                if t.disabled or not t.t0:
+                    continue
+                db.execute("INSERT INTO test_runs VALUES (?,?,?,?,?,?,?)",
+                           (self.ci.site_name, self.ci.build_name, t.name,
+                            t.t0, t.t1 - t.t0, t.exit_value,
+                            int(t.issuccess)))
+            db.commit()
+        except (sqlite3.Error, OSError), e:
+            self._error(e)
+
+    def durations(self, name, runs=HISTORY_RUNS, success_only=False):
+        """\
+        Get the durations of the last 'runs' runs of the test, the most
+        recent first. If 'success_only' is True, only the successful runs
+        are taken.
+
+        """
+        import sqlite3
+
+        sql = "SELECT duration FROM test_runs WHERE site=? AND build=? " \
+              "AND name=?"
+        if success_only:
+            sql = sql + " AND success=1"
+        sql = sql + " ORDER BY start DESC LIMIT ?"
+        try:
+            cur = self._open().execute(sql, (self.ci.site_name,
+                                             self.ci.build_name, name, runs))
+            return [row[0] for row in cur]
+        except (sqlite3.Error, OSError), e:
+            self._error(e)
+            return []
+
+    def expected_duration(self, name):
+        """\
+        Get the average duration of the last runs of the test, or None if
+        the test has no history.
+
+        """
+        durs = self.durations(name)
+        if not durs:
+            return None
+        return sum(durs) / len(durs)
+
+    def adaptive_timeout(self, name):
+        """\
+        Get the timeout for the test from the durations of its last
+        successful runs: the 99th percentile times ADAPTIVE_TIMEOUT_FACTOR,
+        but at least ADAPTIVE_TIMEOUT_MIN seconds. Returns None if there
+        are less than ADAPTIVE_TIMEOUT_MIN_RUNS runs.
+
+        """
+        durs = self.durations(name, ADAPTIVE_TIMEOUT_RUNS, success_only=True)
+        if len(durs) < ADAPTIVE_TIMEOUT_MIN_RUNS:
+            return None
+        durs.sort()
+        p99 = durs[int(math.ceil(0.99 * len(durs))) - 1]
+        return max(ADAPTIVE_TIMEOUT_MIN, p99 * ADAPTIVE_TIMEOUT_FACTOR)
+
+    def perf_regression(self, name, duration):
+        """\
+        Check if the test has become persistently slower: the successful
+        run which took 'duration' seconds and the previous
+        PERF_REGRESSION_RUNS-1 successful runs all took more than
+        PERF_REGRESSION_FACTOR times (and PERF_REGRESSION_MIN seconds
+        more than) the median of the successful runs before them. Returns
+        that median if so, otherwise None.
+
+        """
+        durs = self.durations(name,
+                              ADAPTIVE_TIMEOUT_RUNS + PERF_REGRESSION_RUNS - 1,
+                              success_only=True)
+        recent = [duration] + durs[:PERF_REGRESSION_RUNS - 1]
+        baseline = durs[PERF_REGRESSION_RUNS - 1:]
+        if len(baseline) < ADAPTIVE_TIMEOUT_MIN_RUNS:
+            return None
+        baseline.sort()
+        median = baseline[len(baseline) / 2]
+        fastest = min(recent)
+        if fastest > median * PERF_REGRESSION_FACTOR and \
+           fastest - median > PERF_REGRESSION_MIN:
+            return median
+        return None
+
+    def query(self, name=None):
+        """\
+        Get (site, build, name, start, duration, exit_value, success) rows
+        of test runs, ordered by site, build, test name, and start time.
+        The rows are filtered by the site and build name of the CCDash
+        instance if they are set, and by test 'name' if specified.
+
+        """
+        conds = []
+        args = []
+        if self.ci.site_name:
+            conds.append("site=?")
+            args.append(self.ci.site_name)
+        if self.ci.build_name:
+            conds.append("build=?")
+            args.append(self.ci.build_name)
+        if name:
+            conds.append("name=?")
+            args.append(name)
+        sql = "SELECT * FROM test_runs"
+        if conds:
+            sql = sql + " WHERE " + " AND ".join(conds)
+        sql = sql + " ORDER BY site, build, name, start"
+        return self._open().execute(sql, args).fetchall()
+
+
+class Journal:
+    """\
+    This class keeps the journal of a scenario submission, so that an
+    interrupted run can be resumed with --resume. The journal records the
+    build stamp and the temporary directory of the run, each operation
+    which has been completed (by its key, see Submission.op_key()) with
+    its XML file, and each XML file which has been sent. The lines of the
+    file are tab separated:
+
+        stamp   STAMP   TMPDIR
+        done    KEY     FILE
+        sent    FILE
+
+    """
+    def __init__(self, ci, filename):
+        import threading
+
+        self.ci = ci                    # CCDash instance
+        self.filename = filename        # Journal file
+        self.stamp = None               # Build stamp of the run
+        self.tmpdir = None              # Temporary directory of the run
+        self.done = {}                  # Key vs XML file ("" if none)
+        self.sent = set()               # XML files which have been sent
+        self.lock = threading.Lock()
+
+    def load(self):
+        """\
+        Read the journal of the previous run. Returns False if there is
+        none.
+
+        """
+        if not os.path.isfile(self.filename):
+            return False
+        f = open(self.filename, "r")
+        for line in f:
+            fields = line.rstrip("\r\n").split("\t")
+            if fields[0] == "stamp" and len(fields) == 3:
+                self.stamp, self.tmpdir = fields[1:]
+            elif fields[0] == "done" and len(fields) == 3:
+                self.done[fields[1]] = fields[2]
+            elif fields[0] == "sent" and len(fields) == 2:
+                self.sent.add(fields[1])
+        f.close()
+        return self.stamp is not None
+
+    def _write(self, fields, mode="a"):
+        self.lock.acquire()
+        try:
+            f = open(self.filename, mode)
+            f.write("\t".join(fields) + "\n")
+            f.close()
+        finally:
+            self.lock.release()
+
+    def start(self, stamp, tmpdir):
+        """\
+        Start new journal, discarding the previous one.
+
+        """
+        dirname = os.path.dirname(self.filename)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        self.stamp = stamp
+        self.tmpdir = tmpdir
+        self.done = {}
+        self.sent = set()
+        self._write(["stamp", stamp, tmpdir], "w")
+
+    def add_done(self, key, fname):
+        self.done[key] = fname or ""
+        self._write(["done", key, fname or ""])
+
+    def add_sent(self, fname):
+        self.sent.add(fname)
+        self._write(["sent", fname])
+
+    def remove(self):
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+
+
+class BuildCache:
+    """\
+    This class keeps the configure and build submissions of successful
+    scenario runs, so that configure and build can be skipped when the
+    source revision and the build settings have not changed since. Each
+    entry is a subdirectory named by the key (see Submission.cache_key()),
+    containing the XML files named by the operation keys (see
+    Submission.op_key()).
+
+    Several submissions may build in the same working directory, so the
+    working directory is marked with the key of the build it holds (see
+    mark()). The entry is only used if the mark matches, i.e. if the
+    binaries in the working directory are from that build.
+
+    """
+    def __init__(self, ci, dirname):
+        self.ci = ci                    # CCDash instance
+        self.dirname = dirname          # Cache directory
+
+    def lookup(self, key, wdir):
+        """\
+        Get the XML files of the entry as dictionary of operation key vs
+        file name, or None if there is no entry or if the last build in
+        'wdir' was not the one of the entry.
+
+        """
+        edir = os.path.join(self.dirname, key)
+        if not os.path.isfile(os.path.join(edir, "complete")):
+            return None
+        try:
+            f = open(os.path.join(wdir, BUILD_CACHE_MARK))
+            mark = f.read().strip()
+            f.close()
+        except IOError:
+            return None
+        if mark != key:
+            self.ci.trace(1, "  cached build is not the last build in '%s'" % \
+                             (wdir))
+            return None
+        files = {}
+        for n in os.listdir(edir):
+            if n.endswith(".xml"):
+                files[n[:-4]] = os.path.join(edir, n)
+        return files
+
+    def mark(self, key, wdir):
+        """\
+        Mark 'wdir' as holding the build of the key.
+
+        """
+        f = open(os.path.join(wdir, BUILD_CACHE_MARK), "w")
+        f.write(key + "\n")
+        f.close()
+
+    def store(self, key, files, wdir):
+        """\
+        Save the XML files (dictionary of operation key vs file name) as
+        the entry for the key, mark 'wdir' as holding that build, and remove
+        the oldest entries if there are more than BUILD_CACHE_ENTRIES of
+        them.
+
+        """
+        edir = os.path.join(self.dirname, key)
+        if os.path.exists(edir):
+            shutil.rmtree(edir)
+        os.makedirs(edir)
+        for op_key, fname in files.items():
+            shutil.copyfile(fname, os.path.join(edir, op_key + ".xml"))
+        # The entry is only used once it is complete
+        open(os.path.join(edir, "complete"), "w").close()
+        self.mark(key, wdir)
+        self.ci.trace(1, "  build result saved in cache '%s'" % (edir))
+
+        entries = []
+        for n in os.listdir(self.dirname):
+            path = os.path.join(self.dirname, n)
+            if os.path.isdir(path):
+                entries.append((os.path.getmtime(path), path))
+        entries.sort()
+        for mtime, path in entries[:-BUILD_CACHE_ENTRIES]:
+            shutil.rmtree(path, True)
+
+    def restore(self, fname, dst):
+        """\
+        Write cached XML file to 'dst', with the site, build name, and build
+        stamp of this submission.
+
+        """
+        import xml.dom.minidom
+
+        doc = xml.dom.minidom.parse(fname)
+        site = doc.documentElement
+        site.setAttribute("Name", self.ci.site_name)
+        site.setAttribute("BuildName", self.ci.build_name)
+        site.setAttribute("BuildStamp", self.ci.stamp)
+        f = open(dst, "w")
+        f.write(doc.toxml("utf-8"))
+        f.close()
+        doc.unlink()
+
+
 class CCDash:
     """This class contains basic identifications about the submission,
     program settings, as well as some utility functions.
@@ -225,6 +1207,10 @@ class CCDash:
         self.no_upload = False          # Don't upload
         self.xml_out = None             # Save XML output to file
         self.t1 = 0                     # Test timeout
+        self.jobs = 1                   # Number of tests to run at a time
+        self.procs = []                 # Processes being run by exec_cmd()
+        self.stopping = False           # Set by kill_running()
+        self.trace_prefix = ""          # Prefix of the trace messages
         self.verbosity = 0              # Stdout verbosity:
                                         #  0: print nothing,
                                         #  1: print important info,
@@ -239,7 +1225,19 @@ class CCDash:
         self.last_log = True            # If max_log is set to N and this flag
                                         # is set send the last N characters
                                         # rather than the first N.
+        self.max_build_msgs = -1        # Maximum number of distinct build
+                                        # warnings and errors to send
+                                        # -1: no limit
         self.wdir = wdir                # Default working directory
+        self.uploader = None            # HttpUploader, created on demand
+        self.upload_retries = UPLOAD_RETRIES
+                                        # Number of upload retries
+        self.spool_dir = SPOOL_DIR      # Spool for failed uploads
+        self.spool = None               # Spool, created on demand
+        self.history_db = HISTORY_DB    # Test history database, if any
+        self.history = None             # History, created on demand
+        self.build_cache_dir = ""       # Build cache directory, if enabled
+        self.build_cache = None         # BuildCache, created on demand
 
         self.tmp_dir = None
         if sys.platform=="win32":
@@ -248,6 +1246,7 @@ class CCDash:
             self.win32 = False
 
     def trace(self, level, msg):
+        msg = self.trace_prefix + msg
         if level < 0:
             sys.stderr.write(msg + '\n')
         elif level <= self.verbosity:
@@ -271,6 +1270,8 @@ class CCDash:
         return "%.3f" % (elapsed/div)
 
     def tempnam(self, prefix=""):
+        import tempfile
+
         #if self.tmp_dir is None:
         #    try:
         #        return os.tempnam()
@@ -280,40 +1281,127 @@ class CCDash:
         if self.tmp_dir is None:
             self.tmp_dir = tempfile.gettempdir()
 
-        randname = "%s%s%d-%d" % ("cc", prefix, os.getpid(),
-                                  random.randint(0,999))
-        return os.path.join(self.tmp_dir, randname)
+        # Create the file, so that the name is unique also among the
+        # operations running at the same time in this process
+        fd, fname = tempfile.mkstemp(prefix="cc"+prefix, dir=self.tmp_dir)
+        os.close(fd)
+        return fname
+
+    def create_output_buffer(self):
+        """\
+        Create OutputBuffer to capture output which will be submitted with
+        encode_log(), honoring the max_log and last_log settings.
+
+        """
+        return OutputBuffer(self.max_log, self.last_log)
+
+    def _kill_group(self, proc):
+        """\
+        Terminate the process started by exec_cmd() together with all of
+        its children, which are in the same process group: with SIGTERM
+        first, then with SIGKILL if some are still running after
+        KILL_TIMEOUT seconds. On Windows the process tree is killed.
+        Returns the description of how they were stopped.
+
+        """
+        import subprocess
+
+        if self.win32:
+            rc = subprocess.call("taskkill /F /T /PID %d" % (proc.pid),
+                                 stdout=subprocess.PIPE,
+                                 stderr=subprocess.STDOUT)
+            if rc == 128:
+                # taskkill didn't find the process
+                raise OSError(errno.ESRCH, "no such process")
+            return "killed"
+        os.killpg(proc.pid, signal.SIGTERM)
+        t_end = time.time() + KILL_TIMEOUT
+        while time.time() < t_end:
+            time.sleep(0.1)
+            try:
+                os.killpg(proc.pid, 0)
+            except OSError:
+                return "terminated"
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except OSError:
+            return "terminated"
+        return "killed"
+
+    def _terminate_proc(self, proc, notes, killed):
+        """\
+        Timer function of exec_cmd() to stop the process. The messages are
+        added to 'notes', and the way the process was stopped is added to
+        'killed' if it has been stopped.
 
-    def _terminate_proc(self, proc, fout):
+        """
         msg = "*** ccdash timeout: process has been running for "+\
               "too long, attempting to stop it now ***"
         self.trace(-1, "  " + msg)
-        if fout:
-            fout.flush()
-            fout.write("\n" + msg + "\n")
         try:
-            proc.terminate()
-            msg = "*** process terminated successfully ***"
-            self.trace(-1, "  " + msg)
-            if fout: fout.write(msg + "\n")
+            how = self._kill_group(proc)
+        except OSError, e:
+            if e.errno == errno.ESRCH:
+                # The process has just exited by itself
+                self.trace(-1, "  *** process has already exited ***")
+                return
+            how = None
+            errmsg = str(e)
         except Exception, e:
+            how = None
             errmsg = str(e)
+        notes.append("\n" + msg + "\n")
+        if how:
+            msg = "*** process %s successfully ***" % (how)
+            killed.append(how)
+        else:
             msg = "*** error terminating process: %s ***" % (errmsg)
-            self.trace(-1, "  " + msg)
-            if fout: fout.write(msg + "\n")
+        self.trace(-1, "  " + msg)
+        notes.append(msg + "\n")
+
+    def kill_running(self):
+        """\
+        Stop the processes which are being run by exec_cmd() in the other
+        threads, and the ones started after this. This is used on Ctrl-C,
+        which the processes don't get since they are in their own process
+        groups.
+
+        """
+        self.stopping = True
+        for proc in self.procs[:]:
+            try:
+                self._kill_group(proc)
+            except OSError:
+                pass
 
     def exec_cmd(self, cmdline, out_fname=None, ret_output=False,
-                 filter_func=None):
+                 filter_func=None, out_buf=None, cwd=None, timeout=None):
         """\
         This is a utility function to execute 'cmdline' and capture the stdout
         and stderr output of the process.
 
-        If 'out_fname' is specified, then the output will be saved to that
-        file.
+        The output is read from a pipe while the process is running, and each
+        line is traced and passed to 'filter_func' as soon as it arrives.
+
+        If 'out_fname' is specified, then the output will also be saved to
+        that file. Otherwise the output is not written to disk at all.
 
         If 'ret_output" is set to True, the function will return the whole
         output content in the return tuple value.
 
+        If 'out_buf' is specified, the output is written to that OutputBuffer
+        instead, and the buffer is returned as the output (see OutputBuffer
+        to limit the amount of output kept in memory).
+
+        If 'cwd' is specified, the command is executed in that directory,
+        without changing the working directory of this process (so that
+        several commands can be executed at the same time).
+
+        The command is stopped together with the processes it has started
+        if it runs for longer than 'timeout' seconds (the test timeout
+        't1' if it is None, no limit if it is 0). The command is started
+        in a new process group for this.
+
         The 'filter_func' argument is a function which will be called to
         process each line from the output. The function could be a member
         function or plain function, and it must be declared as:
@@ -324,34 +1412,56 @@ class CCDash:
         This function returns ExecStatus object.
 
         The ExecStatus.output will contain empty string if 'ret_output"
-        argument is False, otherwise it will contain the whole output.
+        argument is False, otherwise it will contain the whole output (or
+        'out_buf' if it is specified).
 
         The ExecStatus.errmsg will be None if the command was executed,
         otherwise it will contain the error string returned by the OS.
 
         The ExecStatus.retcode contains the return value of the executed
-        process.
+        process, and ExecStatus.timed_out tells if it was stopped because
+        of the timeout.
 
         """
+        import subprocess
+        import threading
+
         fout = None
         proc = None
         errmsg = ""
-        out_str = ""
-        is_tmp = False
-        if out_fname:
-            fout = open(out_fname, "w")
+        out_list = []
+        if out_buf is not None:
+            out_write = out_buf.write
+        elif ret_output:
+            out_write = out_list.append
         else:
-            out_fname = self.tempnam("exec")
-            fout = open(out_fname, "w")
-            is_tmp = True
+            out_write = None
+        if timeout is None:
+            timeout = self.t1
+        if out_fname:
+            fout = open(out_fname, "wb")
         try:
             self.trace(1, "  executing '%s'.." % (cmdline))
             # Notes:
             #  - we only use shell on non Win32 since the shell in Win32
             #    is CMD.EXE, and we want to be able to run this on mingw.
+            #  - the command gets its own process group, so that the
+            #    processes started by the shell can be killed with it.
+            #  - the other file descriptors are closed, so that the command
+            #    doesn't keep the output pipe of another command run in
+            #    parallel open (on Win32 it's not supported with pipes).
+            if self.win32:
+                preexec_fn = None
+            else:
+                preexec_fn = os.setpgrp
             proc = subprocess.Popen(cmdline, shell=not self.win32,
+                                    cwd=cwd or None,
+                                    preexec_fn=preexec_fn,
+                                    close_fds=not self.win32,
                                     stdin=subprocess.PIPE,
-                                    stdout=fout, stderr=subprocess.STDOUT,
+                                    stdout=subprocess.PIPE,
+                                    stderr=subprocess.STDOUT,
+                                    bufsize=-1,
                                     universal_newlines=False)
         except Exception, e:
             errmsg = str(e)
@@ -364,105 +1474,137 @@ class CCDash:
                 if sys.hexversion >= 0x02060000: proc.terminate()
                 else: proc.communicate()
                 proc = None
-            fout.close()
-            try:
-                if is_tmp: os.remove(out_fname)
-            except:
-                pass
+            if fout:
+                fout.close()
             self.trace(-1, "  error: %s" % (errmsg))
             return ExecStatus(cmdline, None, errmsg, 127)
 
         # Make the process get EOF when reading stdin.
         proc.stdin.close()
 
-        # Spawn timer to kill the process if it's running for too log
+        # Let kill_running() find the process, and stop it if it has been
+        # called already
+        self.procs.append(proc)
+        if self.stopping:
+            try:
+                self._kill_group(proc)
+            except OSError:
+                pass
+
+        # Spawn timer to kill the process if it's running for too log.
+        # The timer thread doesn't touch the output, it only leaves its
+        # messages in 'notes' to be appended to the output below.
         # Only in Python 2.6
-        if self.t1 > 0 and sys.hexversion >= 0x02060000:
-            timer = threading.Timer(self.t1, self._terminate_proc,
-                                    (proc, fout))
+        notes = []
+        killed = []
+        if timeout > 0 and sys.hexversion >= 0x02060000:
+            timer = threading.Timer(timeout, self._terminate_proc,
+                                    (proc, notes, killed))
             timer.start()
         else:
             timer = None
 
-        # Wait for process to complete
-        proc.communicate()
-
-        if timer and timer.is_alive():
+        # Process output as it arrives. This is done by a separate thread
+        # since the pipe may be kept open by background processes started
+        # by the command, and we don't want to wait for them forever.
+        reader = _OutputReader(self, fout, out_write, filter_func)
+        reader_thread = threading.Thread(target=reader.read_from,
+                                         args=(proc.stdout,))
+        reader_thread.setDaemon(True)
+        reader_thread.start()
+
+        # Wait for process to complete. The process is in another process
+        # group, so it doesn't get the Ctrl-C from the terminal.
+        try:
+            proc.wait()
+        except KeyboardInterrupt:
+            if timer:
+                timer.cancel()
+            if not self.win32:
+                try:
+                    os.killpg(proc.pid, signal.SIGTERM)
+                except OSError:
+                    pass
+            raise
+        finally:
+            self.procs.remove(proc)
+
+        if timer:
             timer.cancel()
-            # Join the thread to make sure that output has been flushed to
-            # fout before we close it below. Also without this, it's possible
-            # that the timer thread is still trying to write something to
-            # fout after we close it.
+            # Join the thread to make sure that it has finished writing
+            # its messages before we look at them.
             timer.join()
             timer = None
 
-        # Process output
-        fout.close()
-        fout = open(out_fname, "r")
-        line_num = 0
-        while True:
-            line_str = fout.readline()
-            if line_str=="":
-                break
-            line_str = line_str.replace("\r", "")
-            line_num = line_num + 1
-            if ret_output:
-                out_str = out_str + line_str
-            line_str = line_str.rstrip("\r\n")
-            self.trace(2, "   " + line_str)
-            if filter_func:
-                filter_func(line_str, line_num)
-
-        fout.close()
-        if is_tmp:
-            try:
-                os.remove(out_fname)
-            except:
-                pass
+        # Give the reader some time to pick up the rest of the output
+        reader_thread.join(OUTPUT_DRAIN_TIMEOUT)
+        reader.stop()
 
-        return ExecStatus(cmdline, out_str, None, proc.returncode)
+        timed_out = len(killed) > 0
+        for line_str in "".join(notes).splitlines(True):
+            reader.process_line(line_str)
 
+        if fout:
+            fout.close()
 
-    def encode_log(self, success, log, encoding="", compression=""):
+        if out_buf is not None:
+            return ExecStatus(cmdline, out_buf, None, proc.returncode,
+                              timed_out)
+        return ExecStatus(cmdline, "".join(out_list), None, proc.returncode,
+                          timed_out)
+
+    def log_body(self, success, log, encoding="", compression=""):
         """\
-        Encode the specified log messages using the specified encoding and
-        compression, taking into account the various output log settings.
+        Create LogBody to encode the specified log messages using the
+        specified encoding and compression, taking into account the various
+        output log settings. Returns empty string if the log is not to be
+        submitted.
 
         """
         if len(log)==0:
             return ""
-        if self.log_level==0:
-            return ""
-        elif self.log_level==1 and success:
+        if not self._want_log(success):
             return ""
+        return LogBody(log=log, encoding=encoding, compression=compression,
+                       max_log=self.max_log, last_log=self.last_log)
+
+    def log_file_body(self, success, filename, encoding="", compression=""):
+        """\
+        Same as log_body(), but the log is read from the specified file
+        each time the body is written, so the file must be kept until the
+        XML document has been written.
 
-        if self.max_log == 0:
+        """
+        if not self._want_log(success) or os.path.getsize(filename)==0:
             return ""
-        elif self.max_log > 0 and len(log) > self.max_log:
-            if self.last_log:
-                log = "(Output trimmed to last " + str(self.max_log) + \
-                       " bytes)\n.."+ log[len(log)-self.max_log:]
-            else:
-                log = log[:self.max_log] + "..\n" + \
-                      "(Output trimmed to the first " + str(self.max_log) + \
-                      " bytes)\n"
-
-        if compression.find("gzip") >= 0 or compression.find("gz") >= 0:
-            tmpnam = self.tempnam("gz")
-            f = gzip.open(tmpnam, "wb")
-            f.write(log)
-            f.close()
-            f = open(tmpnam, "rb")
-            log = f.read()
-            f.close()
-            os.remove(tmpnam)
+        return LogBody(filename=filename, encoding=encoding,
+                       compression=compression, max_log=self.max_log,
+                       last_log=self.last_log)
 
-        if encoding.find("base64") >= 0:
-            log = base64.b64encode(log)
+    def _want_log(self, success):
+        if self.log_level==0:
+            return False
+        elif self.log_level==1 and success:
+            return False
+        return self.max_log != 0
+
+    def encode_log(self, success, log, encoding="", compression=""):
+        """\
+        Encode the specified log messages using the specified encoding and
+        compression, taking into account the various output log settings.
 
-        return log
+        """
+        body = self.log_body(success, log, encoding, compression)
+        if not body:
+            return ""
+        w = _ListWriter()
+        body.write(w)
+        return w.getvalue()
 
     def merge_files(self, files):
+        import platform
+        import xml.dom.minidom
+
         docs = []
         mrt = MergedTesting()
 
@@ -534,18 +1676,114 @@ class CCDash:
         gzip the specified filename, encode it in base64, and return the
         content as string.
 
-        Note: base64 and gzip utilities are needed
         """
-        f = open(filename, "rb")
-        log = f.read()
-        f.close()
-        return self.encode_log(success, log, encoding, compression)
+        body = self.log_file_body(success, filename, encoding, compression)
+        if not body:
+            return ""
+        w = _ListWriter()
+        body.write(w)
+        return w.getvalue()
+
+    def upload_file(self, filename, url=None, uploader=None):
+        """\
+        Send the file to 'url' (default is the submit URL) with HTTP PUT,
+        reusing the connection of the previous upload to the same host.
+        Connection errors and server errors are retried 'upload_retries'
+        times, doubling the delay between the attempts. Returns ExecStatus
+        object.
+
+        The 'uploader' argument specifies the HttpUploader to use, which is
+        needed when uploading from more than one thread at a time.
+
+        """
+        if url is None:
+            url = self.submit_url
+        if uploader is None:
+            if self.uploader is None:
+                self.uploader = HttpUploader()
+            uploader = self.uploader
+        delay = UPLOAD_RETRY_DELAY
+        retry = 0
+        while True:
+            self.trace(1, "  uploading '%s' to %s.." % (filename, url))
+            ret = uploader.put_file(filename, url)
+            if not ret.error() or retry >= self.upload_retries:
+                return ret
+            # Retry on connection errors, timeouts, and server errors
+            if not _upload_temporary_error(ret):
+                return ret
+            retry = retry + 1
+            self.trace(1, "  %s, retrying in %d seconds.." % (str(ret), delay))
+            time.sleep(delay)
+            delay = delay * 2
+
+    def get_history(self):
+        """\
+        Get History instance, or None if test history is disabled.
+
+        """
+        if self.history is None and self.history_db:
+            self.history = History(self, self.history_db)
+        return self.history
+
+    def get_build_cache(self):
+        """\
+        Get BuildCache instance, or None if the build cache is disabled.
+
+        """
+        if self.build_cache is None and self.build_cache_dir:
+            self.build_cache = BuildCache(self, self.build_cache_dir)
+        return self.build_cache
+
+    def clear_build_mark(self):
+        """\
+        Remove the build cache mark of the working directory (see
+        BuildCache.mark()), since the build in it is about to change.
+
+        """
+        if self.wdir:
+            fname = os.path.join(self.wdir, BUILD_CACHE_MARK)
+            if os.path.isfile(fname):
+                os.remove(fname)
+
+    def get_spool(self):
+        if self.spool is None:
+            self.spool = Spool(self, self.spool_dir)
+        return self.spool
+
+    def submit_file(self, filename):
+        """\
+        Upload the file to the submit URL, or put it in the spool if the
+        upload fails, to be sent later with "ccdash.py drain". Once a file
+        for this build stamp is in the spool, the subsequent files for the
+        same stamp go to the spool too, to keep the submission order.
+
+        Returns ExecStatus object of the upload, or None if the file has
+        been added to the spool. Files rejected by the server (HTTP 4xx)
+        are not put in the spool, since sending them again won't help.
+
+        """
+        spool = self.get_spool()
+        if not spool.has_batch(self.stamp):
+            ret = self.upload_file(filename)
+            if ret.output:
+                self.trace(2, "   " + ret.output)
+            if not ret.error():
+                return ret
+            self.trace(-1, "  " + str(ret))
+            if not _upload_temporary_error(ret):
+                return ret
+        spool.add(self.stamp, filename, self.submit_url)
+        return None
 
     def upload_xml(self, data):
         """\
-        Encode the XML node in 'doc' and send it with HTTP PUT.
+        Write the XML document to file and send it with HTTP PUT. The 'data'
+        argument is either a Node, which is streamed directly to the file, or
+        an already encoded XML string. If the upload fails, the document is
+        kept in the spool (see submit_file()). Exits if the server has
+        rejected the document.
 
-        Note: curl is needed
         """
         if self.xml_out:
             tmp = self.xml_out
@@ -554,17 +1792,17 @@ class CCDash:
             tmp = self.tempnam("xml")
             self.trace(1, "  temporary output xml saved to '" + tmp + "'")
         f = open(tmp, "w")
-        f.write(data)
+        if isinstance(data, Node):
+            data.write(f)
+        else:
+            f.write(data)
         f.close()
         if not self.no_upload:
-            cmd = "curl -T %s %s" % (tmp, self.submit_url)
-            ret = self.exec_cmd(cmd, ret_output=True)
-            if ret.output:
-                self.trace(2, "   " + ret.output)
-            if ret.error():
+            ret = self.submit_file(tmp)
+            if ret is not None and ret.error():
                 if tmp != self.xml_out:
                     os.remove(tmp)
-                self.err_exit(str(ret))
+                self.err_exit("Error: the submission has been rejected by the server")
         else:
             self.trace(1, "  not uploading (disabled by cmdline)")
         if tmp != self.xml_out:
@@ -575,6 +1813,8 @@ class CCDash:
         Create <Site> XML node.
 
         """
+        import platform
+
         return Node("Site",
                     attrs = {"Name": self.site_name,
                              "Generator": PROG,
@@ -585,35 +1825,53 @@ class CCDash:
                              "OSVersion": platform.version()})
 
 
-class BuildMsgItem:
+class BuildMsgItem(object):
     """\
     This class represents a single build warning or error, which was parsed
     by the Build class from the compiler output.
 
+    To keep the memory use low with many messages, the message text and
+    its context lines are normally not kept in the instance (with 'text'
+    set to None). They are read from the build log by line number when
+    the XML is created, see Build.read_log_lines().
+
     """
+    __slots__ = ("type", "log_line_num", "text", "text_pos", "file", "line",
+                 "pre", "post", "rep")
+
     def __init__(self, type, log_line_num, text, file, line, \
-                 pre="", post="", rep="0"):
+                 pre="", post="", rep=0, text_pos=0):
         self.type = type
         self.log_line_num = log_line_num
-        self.text = text
+        self.text = text        # Message text, or None to read from log
+        self.text_pos = text_pos
+                                # Start of the text in the log line
         self.file = file
         self.line = line
         self.pre = pre
         self.post = post
-        self.rep = rep
+        self.rep = rep          # Number of times the message is repeated
 
-    def create_xml(self):
+    def create_xml(self, lines=None):
         """\
-        Create <Warning> or <Error> XML node.
+        Create <Warning> or <Error> XML node. The 'lines' argument is
+        dictionary of log line number vs the line, which must contain the
+        message line and its context lines if 'text' is None.
 
         """
+        if self.text is None:
+            text = lines[self.log_line_num][self.text_pos:]
+            pre = lines.get(self.log_line_num - 1)
+            post = lines.get(self.log_line_num + 1)
+        else:
+            text, pre, post = self.text, self.pre, self.post
         w = Node(self.type)
         w.insertNode(Node("BuildLogLine", body=str(self.log_line_num)))
-        w.insertNode(Node("Text", body=self.text))
+        w.insertNode(Node("Text", body=text))
         w.insertNode(Node("SourceFile", body=self.file))
         w.insertNode(Node("SourceLineNumber", body=str(self.line)))
-        w.insertNode(Node("PreContext", body=str(self.pre)))
-        w.insertNode(Node("PostContext", body=str(self.post)))
+        w.insertNode(Node("PreContext", body=str(pre)))
+        w.insertNode(Node("PostContext", body=str(post)))
         w.insertNode(Node("RepeatCount", body=str(self.rep)))
         return w
 
@@ -628,6 +1886,20 @@ class Operation:
     def create_xml(self):
         return None
 
+    def reset(self):
+        """\
+        Clear the result of the previous run, so that the operation can be
+        executed again (see Submission.reset()).
+        """
+        pass
+
+    def cleanup(self):
+        """\
+        Remove the temporary files of the operation, once its XML document
+        has been written.
+        """
+        pass
+
     def get_name(self):
         return ""
 
@@ -638,6 +1910,23 @@ class Operation:
         sys.stderr.write("Operation.success() is called\n")
         return False
 
+# Compiler messages recognized by Build._parse_output(), in the order they
+# are checked. The keywords are only recognized after the start of the line.
+#  - gcc note, ignored:  path/to/file.c:123: note: the message
+#  - gcc warning:        path/to/file.c:123: warning: the message
+#  - gcc error:          path/to/file.c:123: error: the message
+#  - MSVC warning:       path/to/file(123) : warning Cxxxx: the message
+#  - MSVC error:         path/to/file(123) : error Cxxxx: the message
+#  - MSVC fatal error:   SOMETHING : fatal error XXXX: the message
+#  - Symbian Winscw compile error:
+#                        path/to/file:1234: the message
+# The kind is found with str.find(), which is much faster than a regex
+# scanning the line, and the file and line number are then taken with the
+# patterns below, anchored at the start of the line.
+_gcc_file_line_re = re.compile(r"([^:]*):([^:]*)")
+_winscw_msg_re = re.compile(r":[0-9]+: ")
+_winscw_file_line_re = re.compile(r"([^:]+):([^:]{0,4}):")
+
 class Build(Operation):
     """\
     This class contains functionalities to perform build operation, parse
@@ -652,6 +1941,7 @@ class Build(Operation):
         Attributes:
             - cmd: mandatory, the full cmdline
             - dir: optional, working directory
+            - timeout: optional, timeout in seconds
 
         """
         cmd = node.getAttribute("cmd")
@@ -661,6 +1951,8 @@ class Build(Operation):
         obj = cls(ci, cmd, wdir)
         if node.getAttribute("disabled") and node.getAttribute("disabled")!="0":
                 obj.disabled = True
+        if node.getAttribute("timeout"):
+                obj.timeout = int(node.getAttribute("timeout"))
         return obj
 
     def __init__(self, ci, cmd, wdir=None, build_log=False, build_log_file=""):
@@ -669,7 +1961,8 @@ class Build(Operation):
         self.cmd = cmd                  # Build cmd
         self.wdir = wdir                # Working directory for build cmd
         self.build_log = build_log      # Include build log in submission
-        self.t0 = self.t1 = 0           # Start and end time
+        self.timeout = None             # Timeout in seconds, None for the
+                                        # default (see exec_cmd())
         self.log_file = build_log_file  # Build output/log file
         if self.log_file:
             # Need to convert build_log_file to absolute path, otherwise
@@ -678,11 +1971,22 @@ class Build(Operation):
             self.is_tmp_log = False
         else:
             self.is_tmp_log = True
+        self.max_msgs = -1              # Max distinct warnings and errors
+        if ci is not None:
+            self.max_msgs = ci.max_build_msgs
+        self.reset()
+
+    def reset(self):
+        self.t0 = self.t1 = 0           # Start and end time
+        if self.is_tmp_log:
+            self.log_file = ""          # Created by execute()
         self.warn_err = []              # List of warnings and errors
+        self.warn_err_idx = {}          # (type, file, line, md5 of text)
+                                        # vs item
+        self.dropped = 0                # Number of messages over max_msgs
         self.have_err = False           # Does the list have error
         self.prev_line = self.cur_line = self.next_line = None
         self.line_cnt = 0;              # Build line count
-        self.winscw_err = re.compile(".*:[0-9]+: ")
 
     def get_name(self):
         return "build"
@@ -702,6 +2006,20 @@ class Build(Operation):
             filename = filename[pos+1:]
         return filename
 
+    def _msvc_file_line(self, line_str, pos):
+        """\
+        Get the (line_str, filename, line) of MSVC message, where 'pos' is
+        the position of the " : warning " etc. in the line.
+
+        """
+        line_str = self._good_filename(line_str)
+        p0 = line_str.find("(")
+        p1 = line_str.find(")")
+        if p0>0 and p0 < pos:
+            return line_str, line_str[0:p0], line_str[p0+1:p1]
+        else:
+            return line_str, line_str[0:pos], ""
+
     def _parse_output(self, the_line, line_num):
         """\
         Internal utility function to parse compiler output, encapsulate
@@ -719,103 +2037,174 @@ class Build(Operation):
 
         line_str = self.cur_line
 
-        # gcc note format:
-        #  path/to/file.c:123: note: the message
-        pos = line_str.find("note:")
-        if pos > 0:
-            # ignore
-            return
-
-        # gcc warning format:
-        #  path/to/file.c:123: warning: the message
-        pos = line_str.find("warning:")
-        if pos > 0:
-            tokens = line_str.split(':', 2)
-            self.warn_err.append(BuildMsgItem("Warning", line_num-1, line_str,
-                                              tokens[0], tokens[1],
-                                              pre=self.prev_line,
-                                              post=self.next_line))
-            return
-        # gcc error format:
-        #  path/to/file.c:123: error: the message
-        pos = line_str.find("error:")
-        if pos > 0:
-            tokens = line_str.split(':', 2)
-            self.have_err = True
-            self.warn_err.append(BuildMsgItem("Error", line_num-1, line_str,
-                                              tokens[0], tokens[1],
-                                              pre=self.prev_line,
-                                              post=self.next_line))
+        # All the messages contain colon, so skip the rest quickly
+        if ":" not in line_str:
             return
-        # MSVC warning format:
-        #  path/to/file(123) : warning Cxxxx: the message
-        pos = line_str.find(" : warning ")
-        if pos > 0:
-            line_str = self._good_filename(line_str)
-            p0 = line_str.find("(")
-            p1 = line_str.find(")")
-            if p0>0 and p0 < pos:
-                filename = line_str[0:p0]
-                line = line_str[p0+1:p1]
-            else:
-                filename = line_str[0:pos]
-                line = ""
-            self.warn_err.append(BuildMsgItem("Warning", line_num-1, line_str,
-                                              filename, line,
-                                              pre=self.prev_line,
-                                              post=self.next_line))
+        if line_str.find("note:", 1) > 0:
+            # ignore
             return
-        # MSVC error format:
-        #  path/to/file(123) : error Cxxxx: the message
-        pos = line_str.find(" : error ")
-        if pos > 0:
-            line_str = self._good_filename(line_str)
-            p0 = line_str.find("(")
-            p1 = line_str.find(")")
-            if p0>0 and p0 < pos:
-                filename = line_str[0:p0]
-                line = line_str[p0+1:p1]
+        if line_str.find("warning:", 1) > 0:
+            type = "Warning"
+            filename, line = _gcc_file_line_re.match(line_str).groups()
+        elif line_str.find("error:", 1) > 0:
+            type = "Error"
+            filename, line = _gcc_file_line_re.match(line_str).groups()
+        else:
+            type = "Warning"
+            pos = line_str.find(" : warning ", 1)
+            if pos < 0:
+                type = "Error"
+                pos = line_str.find(" : error ", 1)
+            if pos < 0:
+                pos = line_str.find(" : fatal error ", 1)
+            if pos > 0:
+                line_str, filename, line = self._msvc_file_line(line_str, pos)
             else:
-                filename = line_str[0:pos]
-                line = ""
+                if _winscw_msg_re.search(line_str) is None:
+                    return
+                m = _winscw_file_line_re.match(line_str)
+                if m is None:
+                    return
+                type = "Error"
+                filename, line = m.groups()
+        if type == "Error":
             self.have_err = True
-            self.warn_err.append(BuildMsgItem("Error", line_num-1, line_str,
-                                              filename, line,
-                                              pre=self.prev_line,
-                                              post=self.next_line))
+        key = (type, filename, line, hashlib.md5(line_str).digest())
+        w = self.warn_err_idx.get(key)
+        if w is not None:
+            w.rep = w.rep + 1
+        else:
+            # The text and context will be read from the log file
+            self._add_msg(key, BuildMsgItem(type, line_num-1, None,
+                                            filename, line, pre=None,
+                                            post=None,
+                                            text_pos=len(self.cur_line) - \
+                                                     len(line_str)))
+
+    def _add_msg(self, key, w):
+        """\
+        Add new distinct warning or error to the list, unless the list has
+        reached 'max_msgs' items.
+
+        """
+        if self.max_msgs >= 0 and len(self.warn_err) >= self.max_msgs:
+            self.dropped = self.dropped + 1 + w.rep
             return
-        # MSVC fatal error format:
-        #  SOMETHING : fatal error XXXX: the message
-        pos = line_str.find(" : fatal error ")
-        if pos > 0:
-            line_str = self._good_filename(line_str)
-            p0 = line_str.find("(")
-            p1 = line_str.find(")")
-            if p0>0 and p0 < pos:
-                filename = line_str[0:p0]
-                line = line_str[p0+1:p1]
-            else:
-                filename = line_str[0:pos]
-                line = ""
+        self.warn_err_idx[key] = w
+        self.warn_err.append(w)
+
+    def _merge_msg(self, key, w):
+        """\
+        Add warning or error which was parsed by another Build instance,
+        merging it with the same message if it is already in the list.
+
+        """
+        if w.type == "Error":
             self.have_err = True
-            self.warn_err.append(BuildMsgItem("Error", line_num-1, line_str,
-                                              filename, line,
-                                              pre=self.prev_line,
-                                              post=self.next_line))
+        first = self.warn_err_idx.get(key)
+        if first is not None:
+            first.rep = first.rep + 1 + w.rep
+        else:
+            self._add_msg(key, w)
+
+    def parse_log(self, jobs=1):
+        """\
+        Parse existing build log file 'log_file' instead of executing the
+        build command. The file is split into chunks at line boundaries,
+        which are parsed with a pool of 'jobs' processes (all CPUs if zero),
+        and the context lines at the chunk edges are fixed up afterwards.
+        The result is the same as if the log was parsed while the build is
+        running.
+
+        """
+        import mmap
+        import multiprocessing
+
+        if jobs <= 0:
+            jobs = multiprocessing.cpu_count()
+        self.ci.trace(1, "Parsing build log '" + self.log_file + "'..")
+        self.t0 = self.t1 = os.path.getmtime(self.log_file)
+        size = os.path.getsize(self.log_file)
+        if size == 0:
             return
-        # Symbian Winscw compile error format:
-        #  path/to/file:1234: the message
-        if self.winscw_err.match(line_str):
-            p0 = line_str.find(":")
-            p1 = line_str.find(":", p0+1)
-            if p0>0 and p1>0 and p1-p0<6:
-                filename = line_str[0:p0]
-                line = line_str[p0+1:p1]
-                self.have_err = True
-                self.warn_err.append(BuildMsgItem("Error", line_num-1,
-                                                  line_str, filename, line,
-                                                  pre=self.prev_line,
-                                                  post=self.next_line))
+
+        # Split the file at line boundaries. Make more chunks than jobs,
+        # so that the work is spread evenly.
+        step = max(size / (jobs * 4), PARSE_LOG_CHUNK_SIZE)
+        f = open(self.log_file, "rb")
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        chunks = []
+        start = 0
+        while start < size:
+            end = mm.find("\n", min(start + step, size - 1))
+            if end < 0:
+                end = size
+            else:
+                end = end + 1
+            chunks.append((self.log_file, start, end))
+            start = end
+        mm.close()
+        f.close()
+
+        if jobs > 1 and len(chunks) > 1:
+            pool = multiprocessing.Pool(min(jobs, len(chunks)))
+            results = pool.map(_parse_log_chunk, chunks)
+            pool.close()
+            pool.join()
+        else:
+            results = map(_parse_log_chunk, chunks)
+
+        line_cnt = 0
+        for cnt, warn_err, warn_err_idx, first_line, cur_line, last_line \
+                in results:
+            # Feeding the first line of the chunk parses the last line of
+            # the previous chunk, which needs it as the post context
+            self._parse_output(first_line, line_cnt + 1)
+            keys = {}
+            for key, w in warn_err_idx.iteritems():
+                keys[id(w)] = key
+            for w in warn_err:
+                w.log_line_num = w.log_line_num + line_cnt
+                self._merge_msg(keys[id(w)], w)
+            if cnt > 1:
+                self.cur_line = cur_line
+                self.next_line = last_line
+            line_cnt = line_cnt + cnt
+        self.line_cnt = line_cnt
+        self.ci.trace(1, "  %d lines, %d distinct warnings and errors" % \
+                         (line_cnt, len(self.warn_err)))
+        self._trace_dropped()
+
+    def _trace_dropped(self):
+        if self.dropped:
+            self.ci.trace(1, "  %d more warnings and errors are not " \
+                             "submitted (limited to %d)" % \
+                             (self.dropped, self.max_msgs))
+
+    def read_log_lines(self):
+        """\
+        Read the lines of the build log which contain the warnings and
+        errors and their context. Returns dictionary of line number vs the
+        line, processed in the same way as exec_cmd() does.
+
+        """
+        needed = set()
+        for w in self.warn_err:
+            if w.text is None:
+                needed.update((w.log_line_num - 1, w.log_line_num,
+                               w.log_line_num + 1))
+        lines = {}
+        if not needed:
+            return lines
+        f = open(self.log_file, "rb")
+        line_num = 0
+        for line_str in f:
+            line_num = line_num + 1
+            if line_num in needed:
+                lines[line_num] = line_str.replace("\r", "").rstrip("\n")
+        f.close()
+        return lines
+
     def exit_code(self):
         return int(self.have_err)
 
@@ -829,28 +2218,24 @@ class Build(Operation):
                 return
 
         self.ci.trace(1, "Executing build command: '" + self.cmd + "'..")
+        self.ci.clear_build_mark()
         if not self.log_file:
             self.log_file = self.ci.tempnam("build")
         self.t0 = self.t1 = self.ci.gettime()
         if self.wdir:
-            cwd = os.getcwd()
-            os.chdir(self.wdir)
-            self.ci.trace(1, "  setting work directory: chdir " + self.wdir)
-        else:
-            cwd = None
+            self.ci.trace(1, "  setting work directory: " + self.wdir)
 
         ret = self.ci.exec_cmd(self.cmd,
                                out_fname=self.log_file,
-                               filter_func=self._parse_output)
-
-        if cwd is not None:
-            os.chdir(cwd)
+                               filter_func=self._parse_output,
+                               cwd=self.wdir, timeout=self.timeout)
 
         if ret.error():
             self.have_err = True
             self.warn_err.append(BuildMsgItem("Error", self.line_cnt,
                                               str(ret), "", 0))
 
+        self._trace_dropped()
         self.t1 = self.ci.gettime()
 
     def create_xml(self):
@@ -871,27 +2256,87 @@ class Build(Operation):
         b.insertNode(Node("ElapsedMinutes",
                           body=self.ci.encodedur(self.t1-self.t0)))
         # Warnings and errors
+        lines = self.read_log_lines()
         for w in self.warn_err:
-            b.insertNode(w.create_xml())
+            b.insertNode(w.create_xml(lines))
+        lines = None
         if self.build_log:
+            # The log file is streamed into the XML when it is written,
+            # see cleanup()
             oldmax = self.ci.max_log
             self.ci.max_log = -1
             b.insertNode(Node("Log",
                               attrs={"Encoding": "base64",
                                      "Compression": "/bin/gzip"},
-                              body=self.ci.encode_log_file(False,
-                                                           self.log_file,
-                                                           "base64", "gzip")))
+                              body=self.ci.log_file_body(False,
+                                                         self.log_file,
+                                                         "base64", "gzip")))
             self.ci.max_log = oldmax
+        # Done
+        return s
 
-        # Delete tmp file
-        if self.is_tmp_log:
+    def cleanup(self):
+        """\
+        Delete the temporary build log.
+
+        """
+        if self.is_tmp_log and self.log_file and \
+           os.path.isfile(self.log_file):
             try:
                 os.remove(self.log_file)
-            except:
+            except OSError:
                 pass
-        # Done
-        return s
+
+
+def _parse_log_chunk(args):
+    """\
+    Worker function for Build.parse_log() to parse the lines of build log
+    file between offsets 'start' and 'end'. Returns the tuple (line_count,
+    warn_err, warn_err_idx, first_line, cur_line, last_line), where the line
+    numbers of warn_err are relative to the chunk. The last line of the
+    chunk is not parsed, since its post context is in the next chunk.
+
+    """
+    import mmap
+
+    filename, start, end = args
+    build = Build(None, "")
+    f = open(filename, "rb")
+    mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    mm.seek(start)
+    first_line = None
+    line_num = 0
+    while mm.tell() < end:
+        # Same as what exec_cmd() passes to the filter function
+        line_str = mm.readline().replace("\r", "").rstrip("\n")
+        line_num = line_num + 1
+        if line_num == 1:
+            first_line = line_str
+        build._parse_output(line_str, line_num)
+    mm.close()
+    f.close()
+    return (line_num, build.warn_err, build.warn_err_idx, first_line,
+            build.cur_line, build.next_line)
+
+
+class TestCaseResult(object):
+    """\
+    This class contains the result of a single test case, read from the
+    XML result file of a TestItem.
+
+    """
+    __slots__ = ("name",        # Test case name
+                 "fullname",    # Full name, e.g. with the class name
+                 "status",      # "passed", "failed", or "notrun"
+                 "duration",    # Execution time in seconds
+                 "output")      # Failure message and output, if any
+
+    def __init__(self, name, fullname, status, duration, output):
+        self.name = name
+        self.fullname = fullname
+        self.status = status
+        self.duration = duration
+        self.output = output
 
 
 class TestItem(Operation):
@@ -910,9 +2355,16 @@ class TestItem(Operation):
             - cmd: mandatory, the full cmdline
             - info: optional, longer description
             - wdir: optional, working directory
-            - xmlresult: optional, optional XML result file to pick up,
-                         otherwise the test output is captured from
-                         stdout/stderr
+            - xmlresult: optional, JUnit or CTest XML result file written
+                         by the test, relative to wdir. Each test case in
+                         the file is submitted as a separate test, in
+                         addition to the test itself which has the
+                         stdout/stderr output
+            - paths: optional, glob patterns of the source paths which
+                     the test depends on, separated by space or ';'.
+                     With --affected-only, the test is only run if the
+                     update changes any of these paths.
+            - timeout: optional, timeout in seconds
 
         """
         name = node.getAttribute("name")
@@ -938,6 +2390,11 @@ class TestItem(Operation):
         obj = cls(ci, name, info, cmd, wdir, xmlresult)
         if node.getAttribute("disabled") and node.getAttribute("disabled")!="0":
                 obj.disabled = True
+        obj.paths = re.split(r"[;\s]+", node.getAttribute("paths").strip())
+        if obj.paths == [""]:
+                obj.paths = []
+        if node.getAttribute("timeout"):
+                obj.timeout = int(node.getAttribute("timeout"))
         return obj
 
     def __init__(self, ci, name, info, cmd, wdir=None, xmlresult=""):
@@ -948,11 +2405,24 @@ class TestItem(Operation):
         self.fullname = self.info       # Full name
         self.cmd = cmd                  # Command line
         self.wdir = wdir                # Working directory
+        self.timeout = None             # Timeout in seconds, None for the
+                                        # default (see exec_cmd())
+        self.adaptive_timeout = False   # Lower the timeout from history
+        self.xmlresult = xmlresult      # XML result of the test, if any
+        self.paths = []                 # Source paths the test depends on
+        self.reset()
+
+    def reset(self):
+        self.adapted_timeout = None     # Timeout lowered from history for
+                                        # this run, if any
         self.t0 = self.t1 = 0           # Start and end time
         self.issuccess = False            # Test result
         self.completion = "Completed"   # Completion status
-        self.output = ""                # Full output
-        self.xmlresult = xmlresult      # XML result of the test, if any
+        self.output = ""                # Output (string or OutputBuffer)
+        self.cases = []                 # Test cases read from xmlresult
+        self.notrun = False             # Test is skipped
+        self.perf_regression = None     # Median duration of the previous
+                                        # runs if the test has become slower
         self.exit_val = ""
         self.exit_value = ""
 
@@ -966,8 +2436,20 @@ class TestItem(Operation):
         return self.issuccess
 
     def exit_code(self):
+        if self.notrun:
+            return 0
         return not self.issuccess
 
+    def set_notrun(self, reason):
+        """\
+        Skip the test, it will be reported as not run.
+
+        """
+        self.notrun = True
+        self.completion = "Not Run"
+        self.output = reason
+        self.ci.trace(1, "  Test %s is not run: %s" % (self.name, reason))
+
     def execute(self):
         """\
         Execute the test and capture the result.
@@ -976,35 +2458,182 @@ class TestItem(Operation):
         if self.disabled:
                 self.ci.trace(1, "Test operation disabled")
                 return
+        if self.notrun:
+                return
         self.ci.trace(1, "Executing test command: '" + self.cmd + "'...")
         self.t0 = self.t1 = self.ci.gettime()
         if self.wdir:
-            cwd = os.getcwd()
-            os.chdir(self.wdir)
-            self.ci.trace(2, "  setting workdir: chdir " + self.wdir)
-        else:
-            cwd = None
-
-        ret = self.ci.exec_cmd(self.cmd, ret_output=True)
-        if cwd:
-            os.chdir(cwd)
+            self.ci.trace(2, "  setting workdir: " + self.wdir)
+
+        xmlresult = None
+        if self.xmlresult:
+            # Don't pick up the result of the previous run
+            xmlresult = os.path.join(self.wdir or "", self.xmlresult)
+            if os.path.exists(xmlresult):
+                os.remove(xmlresult)
+
+        timeout = self.timeout
+        if self.adapted_timeout is not None:
+            timeout = self.adapted_timeout
+        self.output = self.ci.create_output_buffer()
+        ret = self.ci.exec_cmd(self.cmd, out_buf=self.output, cwd=self.wdir,
+                               timeout=timeout)
         self.completion = "Completed"
+        if ret.timed_out:
+            self.completion = "Timeout"
+            self.exit_val = "Timeout"
         if ret.error():
             self.issuccess = False
             self.exit_value = str(ret.retcode)
-            self.output = str(ret.output) + "\n" + str(ret)
+            self.output.write("\n" + str(ret))
             self.ci.trace(1, "  Test %s failed: %s" % (self.name, str(ret)))
         else:
-            self.output = ret.output
             self.issuccess = True
             self.ci.trace(1, "  Test %s success" % (self.name))
+        if xmlresult:
+            self.read_xmlresult(xmlresult)
         self.t1 = self.ci.gettime()
 
+    def read_xmlresult(self, filename):
+        """\
+        Read the test cases from JUnit (<testcase>) or CTest (<Test>) XML
+        result file into self.cases. The file is parsed incrementally and
+        every test case element is discarded once it has been read, so
+        large result files don't take much memory. The test fails if any
+        test case has failed, or if the file can't be read.
+
+        """
+        try:
+            import xml.etree.cElementTree as ElementTree
+        except ImportError:
+            import xml.etree.ElementTree as ElementTree
+
+        self.cases = []
+        parents = []            # The elements enclosing the current one
+        try:
+            for event, elem in ElementTree.iterparse(filename,
+                                                     ("start", "end")):
+                if event == "start":
+                    parents.append(elem)
+                    continue
+                parents.pop()
+                if elem.tag == "testcase":
+                    case = self._junit_case(elem)
+                elif elem.tag == "Test" and elem.get("Status"):
+                    case = self._ctest_case(elem)
+                else:
+                    continue
+                self.cases.append(case)
+                # Detach the test case (e.g. from <testsuite>), so that
+                # the parsed test cases don't pile up in the tree
+                elem.clear()
+                if parents:
+                    parents[-1].remove(elem)
+        except (IOError, SyntaxError), e:
+            self.issuccess = False
+            self.output.write("\nError reading %s: %s" % (filename, str(e)))
+            self.ci.trace(1, "  Test %s: error reading %s: %s" % \
+                             (self.name, filename, str(e)))
+            return
+
+        failed = len([c for c in self.cases if c.status=="failed"])
+        self.ci.trace(1, "  Test %s: %d test cases, %d failed" % \
+                         (self.name, len(self.cases), failed))
+        if failed:
+            self.issuccess = False
+
+    def _junit_case(self, elem):
+        name = elem.get("name", "")
+        fullname = name
+        if elem.get("classname"):
+            fullname = elem.get("classname") + "." + name
+        try:
+            duration = float(elem.get("time", 0))
+        except ValueError:
+            duration = 0
+        status = "passed"
+        output = []
+        for child in elem:
+            if child.tag in ("failure", "error"):
+                status = "failed"
+            elif child.tag == "skipped":
+                status = "notrun"
+            elif child.tag not in ("system-out", "system-err"):
+                continue
+            if child.get("message"):
+                output.append(child.get("message"))
+            if child.text and child.text.strip():
+                output.append(child.text.strip())
+        return TestCaseResult(name, fullname, status, duration,
+                              "\n".join(output))
+
+    def _ctest_case(self, elem):
+        import zlib
+
+        name = elem.findtext("Name", "")
+        fullname = elem.findtext("FullName", "") or name
+        status = elem.get("Status")
+        if status not in ("passed", "failed"):
+            status = "notrun"
+        duration = 0
+        for m in elem.findall("Results/NamedMeasurement"):
+            if m.get("name") == "Execution Time":
+                try:
+                    duration = float(m.findtext("Value", "0"))
+                except ValueError:
+                    pass
+        output = ""
+        m = elem.find("Results/Measurement/Value")
+        if m is not None and m.text:
+            output = m.text
+            if m.get("encoding") == "base64":
+                output = base64.b64decode(output)
+                if m.get("compression"):
+                    # zlib or gzip
+                    output = zlib.decompress(output, 15 + 32)
+        return TestCaseResult(name, fullname, status, duration, output)
+
+    def create_cases_xml(self):
+        """\
+        Create <Test> nodes for the test cases read from xmlresult. The
+        names are prefixed with the name of this test.
+
+        """
+        nodes = []
+        for c in self.cases:
+            t = Node("Test", attrs={"Status": c.status})
+            t.insertNode(Node("Name", body=self.name + "/" + c.name))
+            t.insertNode(Node("FullName", body=self.fullname + "/" + c.fullname))
+            t.insertNode(Node("Path", body=self.wdir or os.getcwd()))
+            t.insertNode(Node("FullCommandLine", body=self.cmd))
+            r = Node("Results")
+            t.insertNode(r)
+            n = Node("NamedMeasurement", attrs={"type": "numeric/double",
+                                                "name": "Execution Time"})
+            n.insertNode(Node("Value", body=str(c.duration)))
+            r.insertNode(n)
+            if c.status == "notrun":
+                completion = "Not Run"
+            else:
+                completion = "Completed"
+            n = Node("NamedMeasurement", {"type": "text/string",
+                                          "name": "Completion Status"})
+            n.insertNode(Node("Value", body=completion))
+            r.insertNode(n)
+            m = Node("Measurement")
+            m.insertNode(Node("Value", body=self.ci.log_body(
+                                        c.status!="failed", c.output)))
+            r.insertNode(m)
+            nodes.append(t)
+        return nodes
+
     def create_xml(self):
         if self.disabled:
                 return None
         # <Test>
-        if self.issuccess:
+        if self.notrun:
+            t = Node("Test", attrs={"Status": "notrun"})
+        elif self.issuccess:
             t = Node("Test", attrs={"Status": "passed"})
         else:
             t = Node("Test", attrs={"Status": "failed"})
@@ -1045,9 +2674,16 @@ class TestItem(Operation):
                                           "name": "Exit Value"})
             n.insertNode(Node("Value", body=self.exit_value))
             r.insertNode(n)
+        # Performance Regression
+        if self.perf_regression is not None:
+            n = Node("NamedMeasurement", {"type": "text/string",
+                                          "name": "Performance Regression"})
+            n.insertNode(Node("Value", body="%.1f seconds, was %.1f" % \
+                              (self.t1-self.t0, self.perf_regression)))
+            r.insertNode(n)
         # <Measurement>
         m = Node("Measurement")
-        m.insertNode(Node("Value", body=self.ci.encode_log(self.issuccess,
+        m.insertNode(Node("Value", body=self.ci.log_body(self.issuccess,
                                                            self.output)))
         r.insertNode(m)
         return t
@@ -1063,8 +2699,13 @@ class Test(Operation):
     def __init__(self, ci, items):
         self.ci = ci                # The CCDash instance
         self.items = items          # Test items (list of TestItem)
+        self.reset()
+
+    def reset(self):
         self.t0 = self.t1 = 0       # Test start and end time
         self.last_err = 0           # Last test error
+        for t in self.items:
+            t.reset()
 
     def get_name(self):
         return "test"
@@ -1075,14 +2716,136 @@ class Test(Operation):
     def exit_code(self):
         return self.last_err
 
+    def _worker(self, items):
+        import Queue
+
+        while not self.ci.stopping:
+            try:
+                t = items.get_nowait()
+            except Queue.Empty:
+                break
+            t.execute()
+
     def execute(self):
+        """\
+        Execute the test items, running up to 'jobs' of them at a time
+        (see CCDash.jobs). The results are kept in the items, so they are
+        reported in the order the items are declared.
+
+        """
+        import Queue
+        import threading
+
+        self.start()
+        history = self.ci.get_history()
+        jobs = min(self.ci.jobs, len(self.items))
+        if jobs > 1:
+            self.ci.trace(1, "Running %d tests, %d at a time.." % \
+                             (len(self.items), jobs))
+            items = Queue.Queue()
+            for t in self._schedule(history):
+                items.put(t)
+            threads = []
+            for i in range(jobs):
+                th = threading.Thread(target=self._worker, args=(items,))
+                th.start()
+                threads.append(th)
+            try:
+                # Join with timeout, since join() can't be interrupted
+                for th in threads:
+                    while th.isAlive():
+                        th.join(1)
+            except KeyboardInterrupt:
+                # The tests are in their own process groups and don't get
+                # the Ctrl-C, so stop them here
+                self.ci.trace(-1, "Interrupted, stopping the tests..")
+                self.ci.kill_running()
+                raise
+        else:
+            for t in self.items:
+                t.execute()
+        self.finish()
+
+    def start(self):
+        """\
+        Start the test run. This is called before the items are executed.
+
+        """
         self.t0 = self.t1 = self.ci.gettime()
+        history = self.ci.get_history()
+        if history:
+            for t in self.items:
+                if t.adaptive_timeout:
+                    self._adapt_timeout(t, history)
+
+    def finish(self):
+        """\
+        Finish the test run once the items have been executed, recording
+        the results in the history.
+
+        """
         for t in self.items:
-            t.execute()
             if t.exit_code()!=0:
                 self.last_err = t.exit_code()
+        history = self.ci.get_history()
+        if history:
+            self._check_perf(history)
+            history.record(self.items)
         self.t1 = self.ci.gettime()
 
+    def _adapt_timeout(self, t, history):
+        """\
+        Lower the timeout of the test item to what its history suggests
+        (see History.adaptive_timeout()).
+
+        """
+        timeout = history.adaptive_timeout(t.name)
+        if timeout is None:
+            return
+        limit = t.timeout
+        if limit is None:
+            limit = self.ci.t1
+        if limit and timeout >= limit:
+            return
+        t.adapted_timeout = int(math.ceil(timeout))
+        self.ci.trace(2, "  Test %s timeout is %d seconds from history" % \
+                         (t.name, t.adapted_timeout))
+
+    def _check_perf(self, history):
+        """\
+        Flag the successful test items which have become persistently
+        slower (see History.perf_regression()).
+
+        """
+        for t in self.items:
+            if t.disabled or t.notrun or not t.issuccess or not t.t0:
+                continue
+            t.perf_regression = history.perf_regression(t.name, t.t1 - t.t0)
+            if t.perf_regression is not None:
+                self.ci.trace(-1, "  Warning: test %s performance " \
+                                  "regression: %.1f seconds, was %.1f" % \
+                                  (t.name, t.t1 - t.t0, t.perf_regression))
+
+    def _schedule(self, history):
+        """\
+        Get the items in the order they should be started: the longest
+        first according to the history, which gives the shortest total
+        time when running them in parallel. Tests without history are
+        started first, since they may take long too.
+
+        """
+        if not history:
+            return self.items
+        durs = {}
+        for t in self.items:
+            dur = history.expected_duration(t.name)
+            if dur is None:
+                dur = float("inf")
+            durs[t] = dur
+        items = list(self.items)
+        items.sort(key=lambda t: durs[t], reverse=True)
+        return items
+
     def create_xml(self):
         # <Site>
         s = self.ci.create_node()
@@ -1104,10 +2867,15 @@ class Test(Operation):
         for t in self.items:
                 if not t.disabled:
                         testlist.insertNode(Node("Test", body=t.fullname))
+                        for c in t.cases:
+                                testlist.insertNode(Node("Test",
+                                        body=t.fullname + "/" + c.fullname))
         # Individual <Test> results
         for t in self.items:
                 if not t.disabled:
                         testing.insertNode(t.create_xml())
+                        for n in t.create_cases_xml():
+                                testing.insertNode(n)
         return s
 
 
@@ -1124,6 +2892,7 @@ class Configure(Operation):
         Attributes:
             - cmd: mandatory, the full cmdline
             - wdir: optional, working directory
+            - timeout: optional, timeout in seconds
         """
         cmd = node.getAttribute("cmd")
         if not cmd:
@@ -1132,6 +2901,8 @@ class Configure(Operation):
         obj = cls(ci, cmd, wdir)
         if node.getAttribute("disabled") and node.getAttribute("disabled")!="0":
                 obj.disabled = True
+        if node.getAttribute("timeout"):
+                obj.timeout = int(node.getAttribute("timeout"))
         return obj
 
     def __init__(self, ci, cmd, wdir=None):
@@ -1139,8 +2910,12 @@ class Configure(Operation):
         self.ci = ci                # CCDash instance
         self.cmd = cmd              # configure command
         self.wdir = wdir            # working directory
+        self.timeout = None         # timeout in seconds, None for default
+        self.reset()
+
+    def reset(self):
         self.t0 = self.t1 = 0       # start and end time
-        self.output = None          # Command output
+        self.output = None          # Command output (OutputBuffer)
         self.status = -1            # execution status
 
     def get_name(self):
@@ -1161,24 +2936,21 @@ class Configure(Operation):
                 return
         self.t0 = self.t1 = self.ci.gettime()
         self.ci.trace(1, "Running configure test: '" + self.cmd + "'...")
+        self.ci.clear_build_mark()
         if self.wdir:
-            cwd = os.getcwd()
-            os.chdir(self.wdir)
-            self.ci.trace(2, "  setting workdir: chdir " + self.wdir)
-        else:
-            cwd = None
-        ret = self.ci.exec_cmd(self.cmd, ret_output=True)
-        if cwd:
-            os.chdir(cwd)
+            self.ci.trace(2, "  setting workdir: " + self.wdir)
+        buf = self.ci.create_output_buffer()
+        ret = self.ci.exec_cmd(self.cmd, out_buf=buf, cwd=self.wdir,
+                               timeout=self.timeout)
         if ret.error():
             self.status = 1
-            if ret.output:
-                self.output = ret.output
+            if len(buf):
+                self.output = buf
             else:
                 self.output = str(ret)
         else:
             self.status = 0
-            self.output = ret.output
+            self.output = buf
         self.t1 = self.ci.gettime()
 
     def create_xml(self):
@@ -1195,7 +2967,7 @@ class Configure(Operation):
         c.insertNode(Node("EndDateTime", body=self.ci.encodetime(self.t1)))
         c.insertNode(Node("ElapsedMinutes",
                           body=self.ci.encodedur(self.t1-self.t0)))
-        c.insertNode(Node("Log", body=self.ci.encode_log(self.status==0,
+        c.insertNode(Node("Log", body=self.ci.log_body(self.status==0,
                                                          self.output)))
         return s
 
@@ -1262,17 +3034,20 @@ class Update(Operation):
         self.ci = ci                # CCDash instance
         self.wdir = wdir            # Working directory (optional)
         self.no_update = checkonly  # Don't execute svn update
-        self.t0 = self.t1 = 0       # Time measurement
-        self.base = None            # BASE revision info
-        self.head = None            # HEAD revision info
-        self.file_revs = {}         # Dictionary of filename vs FileRevInfo
-        self.status = ""            # Execution status
         self.type = type            # SCM type
-        self.log = ""               # Log output
         if type=="SVN":
             self.cmd = "svn up"     # Update command"
         else:
             self.ci.err_exit("Unsupported repository type")
+        self.reset()
+
+    def reset(self):
+        self.t0 = self.t1 = 0       # Time measurement
+        self.base = None            # BASE revision info
+        self.head = None            # HEAD revision info
+        self.file_revs = {}         # Dictionary of filename vs FileRevInfo
+        self.status = ""            # Execution status
+        self.log = ""               # Log output
 
     def get_name(self):
         return "update"
@@ -1284,6 +3059,8 @@ class Update(Operation):
         return True
 
     def _svn_get_info(self, rev="", url=""):
+        import xml.dom.minidom
+
         revision = ""
         author = ""
         date = ""
@@ -1295,7 +3072,7 @@ class Update(Operation):
         if url:
             cmd = cmd + " " + url
 
-        ret = self.ci.exec_cmd(cmd, ret_output=True)
+        ret = self.ci.exec_cmd(cmd, ret_output=True, cwd=self.wdir)
         if ret.error():
             self.ci.err_exit(str(ret))
 
@@ -1312,13 +3089,15 @@ class Update(Operation):
         return revision, author, date, url
 
     def _svn_get_commit_info(self, r1, r2="", url=""):
+        import xml.dom.minidom
+
         cmd = "svn log --non-interactive --xml -v -r " + r1
         if r2:
             cmd = cmd + ":" + r2
         if url:
             cmd = cmd + " " + url
 
-        ret = self.ci.exec_cmd(cmd, ret_output=True)
+        ret = self.ci.exec_cmd(cmd, ret_output=True, cwd=self.wdir)
         if ret.error():
             self.ci.err_exit(str(ret))
 
@@ -1344,6 +3123,21 @@ class Update(Operation):
 
         return cis
 
+    def changed(self, patterns):
+        """\
+        Check whether the update has changed any path matching one of the
+        glob patterns. Patterns are matched against the repository path of
+        the file as well as its trailing components, e.g. "pjlib/src/*"
+        matches "/pjproject/trunk/pjlib/src/pj/os_core_unix.c".
+
+        """
+        for path in self.file_revs.iterkeys():
+            for pat in patterns:
+                if fnmatch.fnmatch(path, pat) or \
+                   fnmatch.fnmatch(path, "*/" + pat):
+                    return True
+        return False
+
     def exit_code(self):
         # This implementation currently will call sys.exit(1) if it encounters
         # any errors, so if we get to here then all should be okay.
@@ -1382,7 +3176,8 @@ class Update(Operation):
             if self.no_update:
                 self.ci.trace(1, "  svn update is disabled by cmd-line")
             else:
-                ret = self.ci.exec_cmd("svn update --non-interactive")
+                ret = self.ci.exec_cmd("svn update --non-interactive",
+                                       cwd=self.wdir)
                 if ret.error():
                     self.ci.err_exit(str(ret))
 
@@ -1395,19 +3190,10 @@ class Update(Operation):
                 self.ci.trace(1, "Update operation disabled")
                 return
         self.t0 = self.t1 = self.ci.gettime();
-        if self.wdir:
-            cwd = os.getcwd()
-            os.chdir(self.wdir)
-        else:
-            cwd = None
         if self.type=="SVN":
             self._svn_execute()
         else:
-            if cwd:
-                os.chdir(cwd)
             self.ci.err_exit("Unsupported repository type: " + self.type)
-        if cwd:
-            os.chdir(cwd)
         self.t1 = self.ci.gettime();
 
     def old_check_status(self):
@@ -1433,6 +3219,8 @@ class Update(Operation):
             return 1
 
     def check_status(self):
+        import pysvn
+
         c = pysvn.Client()
 	c.callback_ssl_server_trust_prompt = lambda t: (True, t['failures'], True)
 
@@ -1510,6 +3298,43 @@ class Update(Operation):
 
 
 
+class SvnWatcher:
+    """\
+    This class polls the Subversion repository of a working directory for
+    new revisions, keeping the client and the repository URL between the
+    polls so that each poll is a single request for the HEAD revision.
+
+    """
+    def __init__(self, ci, wdir):
+        import pysvn
+
+        self.ci = ci                # CCDash instance
+        self.wdir = wdir            # Working directory
+        self.client = pysvn.Client()
+        self.client.callback_ssl_server_trust_prompt = \
+            lambda t: (True, t['failures'], True)
+        entry = self.client.info(self.wdir)
+        self.url = entry.url        # Repository URL of the working dir
+        self.base = entry.revision.number   # Revision of the working dir
+
+    def head(self):
+        """\
+        Get the HEAD revision number of the repository.
+
+        """
+        import pysvn
+
+        rev = pysvn.Revision(pysvn.opt_revision_kind.head)
+        info = self.client.info2(self.url, revision=rev, recurse=False)
+        return info[0][1].rev.number
+
+
+# The umask of the process, for the files created with mkstemp(). It can
+# only be read by setting it, which would affect the files created by the
+# other threads meanwhile, so it is read once here.
+_umask = os.umask(0)
+os.umask(_umask)
+
 class FileWrite(Operation):
     """\
     This class represents FileWrite operation in XML scenario file.
@@ -1529,6 +3354,8 @@ class FileWrite(Operation):
             - saveas:  optional, save as new file
             - content as text body
         """
+        import xml.dom
+
         file = node.getAttribute("file")
         if not file:
             return None
@@ -1580,6 +3407,8 @@ class FileWrite(Operation):
         return True
 
     def execute(self):
+        import tempfile
+
         if self.disabled:
                 self.ci.trace(1, "FileWrite operation disabled")
                 return
@@ -1602,10 +3431,39 @@ class FileWrite(Operation):
                 content = pat.sub(self.replace_begin + self.content + self.replace_end, content)
         else:
                 content = self.content
-        # Write to file
-        f = open(self.saveas, "w")
-        f.write(content)
-        f.close()
+        if isinstance(content, unicode):
+                content = content.encode("utf-8")
+
+        # Leave the file alone if the content is the same, so that its
+        # modification time is kept and make doesn't rebuild everything
+        if os.path.isfile(self.saveas):
+                f = open(self.saveas, "r")
+                old_content = f.read()
+                f.close()
+                if old_content == content:
+                        self.ci.trace(1, "  %s is unchanged" % (self.saveas))
+                        return
+
+        # Write to temporary file then rename it, so that the file is never
+        # left half-written
+        dirname, basename = os.path.split(self.saveas)
+        fd, tmpname = tempfile.mkstemp(prefix=basename + ".", dir=dirname or ".")
+        try:
+                f = os.fdopen(fd, "w")
+                f.write(content)
+                f.close()
+                if os.path.isfile(self.saveas):
+                        shutil.copymode(self.saveas, tmpname)
+                        if sys.platform=="win32":
+                                os.remove(self.saveas)
+                else:
+                        os.chmod(tmpname, 0666 & ~_umask)
+                os.rename(tmpname, self.saveas)
+        except:
+                if os.path.exists(tmpname):
+                        os.remove(tmpname)
+                raise
+        self.ci.trace(1, "  %s written" % (self.saveas))
 
     def create_xml(self):
         return None
@@ -1636,6 +3494,12 @@ def create_ccdash(options, check_options=True):
     ccdash.log_level = options.loglevel
     ccdash.last_log = options.lastlog
     ccdash.max_log = options.maxlog
+    ccdash.max_build_msgs = options.max_build_msgs
+    ccdash.jobs = options.jobs or 1
+    ccdash.upload_retries = options.upload_retries
+    ccdash.spool_dir = options.spool_dir
+    ccdash.history_db = options.history_db
+    ccdash.build_cache_dir = options.build_cache_dir
     return ccdash
 
 
@@ -1657,7 +3521,37 @@ def cmd_build(options, args):
     build.execute()
     xml = build.create_xml()
     if xml:
-        ccdash.upload_xml(str(xml))
+        ccdash.upload_xml(xml)
+    build.cleanup()
+    return build.exit_code()
+
+
+def cmd_parse_log(options, args):
+    """\
+    Parse existing build log and submit the result as build operation.
+
+    """
+    if len(args) != 2 and len(args) != 3:
+        sys.stderr.write("Error: the build log FILE is not specified\n")
+        return 1
+    if not os.path.isfile(args[1]):
+        sys.stderr.write("Error: build log '%s' is not found\n" % (args[1]))
+        return 1
+
+    ccdash = create_ccdash(options)
+    if ccdash is None:
+        return 1
+    if len(args) == 3:
+        cmd = args[2]
+    else:
+        cmd = ""
+    build = Build(ccdash, cmd, wdir=options.wdir,
+                  build_log=options.build_log,
+                  build_log_file=args[1])
+    build.parse_log(options.parse_jobs)
+    xml = build.create_xml()
+    if xml:
+        ccdash.upload_xml(xml)
     return build.exit_code()
 
 
@@ -1678,11 +3572,12 @@ def cmd_test(options, args):
     ccdash.t1 = options.t1
 
     item = TestItem(ccdash, args[1], args[1], args[2], options.wdir)
+    item.adaptive_timeout = options.adaptive_timeout
     test = Test(ccdash, [item])
     test.execute()
     xml = test.create_xml()
     if xml:
-        ccdash.upload_xml(str(xml))
+        ccdash.upload_xml(xml)
     return test.exit_code()
 
 
@@ -1691,6 +3586,12 @@ def cmd_status(options):
     Perform status operation.
 
     """
+    try:
+        import pysvn
+    except ImportError:
+        sys.stderr.write("Error: status operation needs pysvn module\n")
+        return 1
+
     ccdash = create_ccdash( options, check_options=False)
     if ccdash is None:
         return 1
@@ -1712,7 +3613,7 @@ def cmd_update(options):
     u.execute()
     xml = u.create_xml()
     if xml:
-        ccdash.upload_xml(str(xml))
+        ccdash.upload_xml(xml)
     return u.exit_code()
 
 
@@ -1733,7 +3634,7 @@ def cmd_configure(options, args):
     conf.execute()
     xml = conf.create_xml()
     if xml:
-        ccdash.upload_xml(str(xml))
+        ccdash.upload_xml(xml)
     return conf.exit_code()
 
 
@@ -1767,10 +3668,11 @@ def cmd_upload(options, args):
         sys.stderr.write("Error: URL not specified\n")
         return 1
 
-    ccdash = CCDash(options.url, "", "", "")
+    ccdash = CCDash(options.url, "", "", "", "")
+    ccdash.verbosity = options.v
+    ccdash.upload_retries = options.upload_retries
 
-    cmdline = "curl -s -f -T %s %s" % (args[1], options.url)
-    ret = ccdash.exec_cmd(cmdline)
+    ret = ccdash.upload_file(args[1])
     if ret.output:
         ccdash.trace(2, "   " + ret.output)
     if ret.error():
@@ -1781,6 +3683,91 @@ def cmd_upload(options, args):
     return 0
 
 
+def cmd_drain(options):
+    """\
+    Upload the submissions in the spool.
+
+    """
+    ccdash = create_ccdash(options, check_options=False)
+    if ccdash is None:
+        return 1
+
+    spool = ccdash.get_spool()
+    batches = spool.batches()
+    if not batches:
+        ccdash.trace(1, "Nothing to upload, spool '%s' is empty" % \
+                        (ccdash.spool_dir))
+        return 0
+
+    ccdash.trace(1, "Uploading %d batch(es) from spool '%s'.." % \
+                    (len(batches), ccdash.spool_dir))
+    failed = spool.drain(options.drain_jobs)
+    if failed:
+        sys.stderr.write("Error: %d of %d batch(es) are not uploaded " \
+                         "completely and are kept in the spool\n" % \
+                         (failed, len(batches)))
+        return 1
+    sys.stdout.write("Upload success\n")
+    return 0
+
+
+def cmd_history(options, args):
+    """\
+    Show the durations of the recorded test runs.
+
+    """
+    import sqlite3
+
+    if len(args) > 2:
+        sys.stderr.write("Error: too many arguments\n")
+        return 1
+    if not options.history_db or not os.path.isfile(options.history_db):
+        sys.stderr.write("Error: no test history database\n")
+        return 1
+
+    # Note: create_ccdash() clears these options
+    site_name = options.site_name or ""
+    build_name = options.build_name or ""
+    ccdash = create_ccdash(options, check_options=False)
+    if ccdash is None:
+        return 1
+    ccdash.site_name = site_name
+    ccdash.build_name = build_name
+    if len(args) == 2:
+        name = args[1]
+    else:
+        name = None
+
+    try:
+        rows = ccdash.get_history().query(name)
+    except sqlite3.Error, e:
+        sys.stderr.write("Error: %s\n" % (str(e)))
+        return 1
+
+    # Group the runs by (site, build, test name)
+    groups = []
+    for row in rows:
+        if not groups or groups[-1][0] != row[:3]:
+            groups.append((row[:3], []))
+        groups[-1][1].append(row)
+
+    fmt = "%-20s %-20s %-20s %5s %8s %8s %8s %8s  %s\n"
+    sys.stdout.write(fmt % ("Site", "Build", "Test", "Runs", "Last",
+                            "Average", "Min", "Max", "Trend"))
+    for key, runs in groups:
+        durs = [row[4] for row in runs]
+        # Trend of the last 10 runs, the oldest first, '!' marks failure
+        trend = []
+        for row in runs[-10:]:
+            trend.append("%.1f%s" % (row[4], ("!", "")[row[6]]))
+        sys.stdout.write(fmt % (key[0], key[1], key[2], len(runs),
+                                "%.1f" % durs[-1],
+                                "%.1f" % (sum(durs) / len(durs)),
+                                "%.1f" % min(durs), "%.1f" % max(durs),
+                                " ".join(trend)))
+    return 0
+
+
 class Submission:
     """\
     One submission entry in scenario file.
@@ -1791,7 +3778,17 @@ class Submission:
         Factory method to create the instance from an xml node.
         Attributes:
             - group: mandatory, group name
+        Attributes of the operation nodes:
+            - id: optional, the name to refer to the operation in 'depends'
+            - depends: optional, the ids of the operations above which must
+                       succeed before this one is run, separated by space
+                       or ';'. If any operation has it, the operations are
+                       run as dependency graph (see execute_graph()), and
+                       those without it depend on the operation above them
+                       (not counting tests). A dependency on an excluded
+                       operation is replaced with its dependencies.
         """
+        import xml.dom
 
         # Copy options
         opts = copy.copy(options)
@@ -1806,20 +3803,41 @@ class Submission:
             sys.stderr.write("Error: missing 'group' attribute in <Submit> and not specified in cmdline\n")
             return None
 
+        if not opts.jobs and submit_node.getAttribute("jobs"):
+                jobs = submit_node.getAttribute("jobs")
+                if not jobs.isdigit() or int(jobs) < 1:
+                        sys.stderr.write("Error: invalid 'jobs' attribute in <Submit>: '%s'\n" % (jobs))
+                        return None
+                opts.jobs = int(jobs)
+
         opts.build_name = submit_node.getAttribute("build")
         if not opts.build_name:
             sys.stderr.write("Error: missing 'build' attribute in <Submit>\n")
             return None
 
+        # Use own copy of the working directory
+        if opts.isolate_dir:
+                opts.wdir = os.path.join(os.path.abspath(opts.isolate_dir),
+                                         re.sub(r"[^\w.-]+", "_",
+                                                opts.build_name))
 
         #opts.no_upload = True
 
         submit = cls(opts)
         if not submit.ci:
             return None
+        if opts.isolate_dir:
+                submit.src_wdir = options.wdir
+                submit.tmpdirname = submit.tmpdirname + "-" + \
+                                    os.path.basename(opts.wdir)
 
         submit.set_exclude(submit_node.getAttribute("exclude"))
 
+        deps = {}               # Dependencies of each operation
+        ids = {}                # id vs operation, None if excluded
+        excluded_ids = {}       # id vs excluded operation
+        prev = None             # Last operation other than test
+        use_graph = False
         for node in submit_node.childNodes:
             ops_list = submit.ops
 
@@ -1851,13 +3869,63 @@ class Submission:
             if not op:
                 sys.stderr.write("Error: error parsing <%s> node\n" % (node.nodeName))
                 return None
-            elif submit.is_op_excluded(op):
+            if opname in ("configure", "build", "test") and op.timeout is None:
+                # Scenario default, otherwise only tests have a timeout
+                if opts.timeout:
+                    op.timeout = opts.timeout
+                elif opname == "test":
+                    op.timeout = opts.t1
+                else:
+                    op.timeout = 0
+                if opname == "test":
+                    op.adaptive_timeout = opts.adaptive_timeout
+
+            op_id = node.getAttribute("id")
+            if op_id in ids:
+                sys.stderr.write("Error: duplicate id '%s'\n" % (op_id))
+                return None
+            is_excluded = submit.is_op_excluded(op)
+            if node.hasAttribute("depends"):
+                use_graph = True
+                deps[op] = []
+                for d in re.split(r"[;\s]+", node.getAttribute("depends").strip()):
+                    if not d:
+                        continue
+                    if d not in ids:
+                        sys.stderr.write("Error: <%s> depends on unknown id '%s' (only the operations above can be depended on)\n" % (node.nodeName, d))
+                        return None
+                    if ids[d] is not None:
+                        dep_ops = [ids[d]]
+                    else:
+                        # Keep the order by waiting for what the excluded
+                        # operation would have waited for
+                        dep_ops = deps[excluded_ids[d]]
+                        if not is_excluded:
+                            submit.ci.trace(-1, "  Warning: <%s> depends on '%s', which is excluded. It will wait for the dependencies of '%s' instead" % (node.nodeName, d, d))
+                    for dep_op in dep_ops:
+                        if dep_op not in deps[op]:
+                            deps[op].append(dep_op)
+            elif prev:
+                deps[op] = [prev]
+            else:
+                deps[op] = []
+
+            if is_excluded:
                 submit.ci.trace(1, "  skipping %s (excluded)..." % (op.get_info()))
+                if op_id:
+                    ids[op_id] = None
+                    excluded_ids[op_id] = op
             else:
                 submit.ci.trace(1, "  adding %s..." % (op.get_info()))
                 ops_list.append(op)
                 #submit.ci.trace(1, "  %s added" % (op.get_name()))
+                if op_id:
+                    ids[op_id] = op
+                if opname != "test":
+                    prev = op
 
+        if use_graph:
+            submit.deps = deps
         return submit
 
     def __init__(self, options):
@@ -1866,11 +3934,35 @@ class Submission:
         if not self.ci:
             return
         self.tmpdirname = os.path.join(os.getcwd(), "tmp", "submit-" + self.ci.stamp)
+        self.src_wdir = None        # Where to copy the working dir from
+        self.journal = None         # Journal of the run
+        self.wc_rev = None          # Working copy revision, see
+                                    # wc_revision()
+        self.deps = None            # Operation vs the operations it
+                                    # depends on, if run as graph
         self.test = None
         self.ops = []
         self.re = None
         self.ci.trace(1, "Submission created")
 
+    def reset(self, timestamp):
+        """\
+        Prepare the submission to be executed again with a new build stamp,
+        clearing the results of the previous run. This is used by the watch
+        operation, which creates the submissions only once.
+
+        """
+        self.options.timestamp = timestamp
+        self.ci.stamp = timestamp + "-" + self.options.group
+        self.tmpdirname = os.path.join(os.getcwd(), "tmp", "submit-" + self.ci.stamp)
+        if self.src_wdir:
+                self.tmpdirname = self.tmpdirname + "-" + \
+                                  os.path.basename(self.options.wdir)
+        self.journal = None
+        self.wc_rev = None
+        for op in self.ops:
+                op.reset()
+
     def set_exclude(self, pattern):
         if (pattern):
                 self.re = re.compile(pattern, re.I | re.DOTALL)
@@ -1883,29 +3975,270 @@ class Submission:
         else:
                 return False
 
+    def select_affected(self, test, update):
+        """\
+        Skip the test items which don't depend on any of the paths changed
+        by the update. Items without 'paths' are always run, as well as all
+        items if there was no update.
+
+        """
+        if update is None:
+                self.ci.trace(1, "  no update information, running all tests")
+                return
+        for t in test.items:
+                if t.paths and not t.disabled and not update.changed(t.paths):
+                        t.set_notrun("not affected by the update")
+
+    def cache_key(self, update):
+        """\
+        Get the build cache key for this submission, which is made of the
+        source revision after the update and the settings of all FileWrite,
+        Configure, and Build operations. Returns None if there is no update
+        information. Note that local modifications are not detected.
+
+        """
+        if update is None:
+                return None
+        if update.no_update:
+                rev = update.base.rev
+        else:
+                rev = update.head.rev
+        h = hashlib.sha1()
+        h.update(repr((self.ci.site_name, self.ci.build_name, self.ci.wdir,
+                       rev)))
+        for op in self.ops:
+                if op.get_name() in ("filewrite", "configure", "build"):
+                        h.update(repr(self._op_spec(op)))
+        return h.hexdigest()
+
+    def _op_spec(self, op):
+        """\
+        Get the settings of the operation, as tuple.
+
+        """
+        name = op.get_name()
+        if name == "filewrite":
+                return (name, op.file, op.saveas, op.replace,
+                        op.replace_begin, op.replace_end, op.content,
+                        op.disabled)
+        elif name in ("configure", "build"):
+                return (name, op.cmd, op.wdir, op.disabled)
+        elif name == "update":
+                return (name, op.wdir, op.type, op.no_update, op.disabled)
+        elif name == "test":
+                return (name, [(t.name, t.cmd, t.wdir, t.xmlresult, t.disabled)
+                               for t in op.items])
+        return (name, op.get_info())
+
+    def wc_revision(self):
+        """\
+        Get the revision of the working directory with svnversion, without
+        the local modification flags, or "" if it is not a Subversion
+        working copy. The result is kept until an update is done.
+
+        """
+        if self.wc_rev is None:
+            ret = self.ci.exec_cmd("svnversion -n .", ret_output=True,
+                                   cwd=self.ci.wdir)
+            rev = ""
+            if not ret.error():
+                rev = ret.output.strip().rstrip("MSP")
+                if not re.match(r"^\d+(:\d+)?$", rev):
+                    # "Unversioned directory", "exported", etc.
+                    rev = ""
+            self.wc_rev = rev
+        return self.wc_rev
+
+    def op_key(self, op):
+        """\
+        Get the journal key of the operation, which is made of its
+        position, its settings, and the working copy revision, so that
+        an operation is not resumed on top of another checkout.
+
+        """
+        h = hashlib.sha1()
+        h.update(repr((self.ops.index(op), self._op_spec(op),
+                       self.wc_revision())))
+        return h.hexdigest()
+
+    def journal_file(self):
+        name = "journal-%s-%s.txt" % (self.options.group, self.ci.build_name)
+        return os.path.join(os.getcwd(), "tmp",
+                            re.sub(r"[^\w.-]+", "_", name))
+
+    def prepare_wdir(self):
+        """\
+        Create the working directory of this submission as a copy of the
+        scenario working directory (see --isolate-dir), unless it has been
+        created by a previous run. Returns False on error.
+
+        """
+        if os.path.isdir(self.ci.wdir):
+                return True
+        self.ci.trace(1, "Copying '%s' to '%s'.." % (self.src_wdir,
+                                                     self.ci.wdir))
+        # Don't copy the copies if they are in the working directory
+        isolate_dir = os.path.abspath(os.path.dirname(self.ci.wdir))
+        def ignore(dirname, names):
+                return [n for n in names
+                        if os.path.abspath(os.path.join(dirname, n)) == \
+                           isolate_dir]
+        tmpname = self.ci.wdir.rstrip("/\\") + ".tmp"
+        try:
+                if os.path.exists(tmpname):
+                        shutil.rmtree(tmpname)
+                shutil.copytree(self.src_wdir, tmpname, symlinks=True,
+                                ignore=ignore)
+                os.rename(tmpname, self.ci.wdir)
+        except (OSError, shutil.Error), e:
+                self.ci.trace(-1, "Error copying working directory: %s" % \
+                                  (str(e)))
+                return False
+        return True
+
     def execute(self):
-        # Create or clear temp dir
-        if os.path.exists(self.tmpdirname):
-            shutil.rmtree(self.tmpdirname)
-        os.makedirs(self.tmpdirname)
+        """\
+        Execute the operations. Each XML document is uploaded in the
+        background as soon as it is created, while the next operation is
+        running. Files which could not be uploaded are put in the spool.
+
+        """
+        if self.src_wdir and not self.prepare_wdir():
+                return 1
+
+        self.journal = Journal(self.ci, self.journal_file())
+        if self.options.resume and self.journal.load() and \
+           os.path.isdir(self.journal.tmpdir):
+                # Continue the previous run with its build stamp
+                self.ci.trace(1, "Resuming the run of %s" % (self.journal.stamp))
+                self.ci.stamp = self.journal.stamp
+                self.tmpdirname = self.journal.tmpdir
+        else:
+                # Create or clear temp dir
+                if os.path.exists(self.tmpdirname):
+                    shutil.rmtree(self.tmpdirname)
+                os.makedirs(self.tmpdirname)
+                self.journal.start(self.ci.stamp, self.tmpdirname)
 
-        idx = 1
         out_files = []
         no_upload = self.ci.no_upload
         self.ci.no_upload = True
+        if not no_upload:
+                # Hold the other files until the build is sent, if any
+                have_build = False
+                for op in self.ops:
+                        if op.get_name() == "build" and not op.disabled:
+                                have_build = True
+                upload = UploadQueue(self.ci, hold=have_build,
+                                     journal=self.journal)
+        else:
+                upload = None
+        if self.deps is not None:
+                self.execute_graph(upload, out_files)
+        else:
+                self.execute_ops(upload, out_files)
+
+        self.ci.no_upload = no_upload
+
+        if upload:
+                self.ci.trace(1, "Waiting for uploads to complete..")
+                spooled = upload.finish()
+                if spooled:
+                        self.ci.trace(-1, "Warning: %d of %d file(s) could not be uploaded and are kept in the spool '%s'. Use 'ccdash.py drain' to send them." % \
+                                          (len(spooled), len(out_files), self.ci.spool_dir))
+                if upload.rejected:
+                        self.ci.trace(-1, "Error: %d of %d file(s) have been rejected by the server" % \
+                                          (len(upload.rejected), len(out_files)))
+        else:
+                self.ci.trace(1, "Not uploading (disabled by cmdline). You can upload manually")
+        # The run is complete, there's nothing to resume
+        self.journal.remove()
+        if upload and upload.rejected:
+                return 1
+        return 0
+
+    def _resume_op(self, op, out_files, upload):
+        """\
+        If the operation has been completed in the previous run, submit its
+        XML file unless it has been sent, and return True.
+
+        """
+        fname = self.journal.done.get(self.op_key(op))
+        if fname is None or (fname and not os.path.isfile(fname)):
+                return False
+        self.ci.trace(1, "  %s has been done, skipping" % (op.get_info()))
+        if fname and fname not in self.journal.sent:
+                self._add_output(op, fname, out_files, upload)
+        return True
+
+    def _add_output(self, op, out_file, out_files, upload):
+        # Put "Build" operation as first element
+        if op.get_name().lower() == "build":
+                out_files.insert(0, out_file)
+                if upload:
+                        upload.put_first(out_file)
+        else:
+                out_files.append(out_file)
+                if upload:
+                        upload.put(out_file)
+
+    def execute_ops(self, upload, out_files):
+        """\
+        Execute the operations one by one. The scenario stops if configure
+        or build fails.
+
+        """
+        idx = 1
         fatal_err = False
+        update = None
+        cache = self.ci.get_build_cache()
+        cache_key = None
+        cached = None           # Cached configure and build XML files
+        built = {}              # Configure and build XML files to cache
+        resuming = self.options.resume
         for op in self.ops:
+            # Continue from the first operation which is not done
+            if resuming and self._resume_op(op, out_files, upload):
+                    idx = idx + 1
+                    continue
+            resuming = False
             self.ci.xml_out = os.path.join(self.tmpdirname, "%03d-%s.xml" % (idx, op.get_name())  )
-            op.execute()
-            xml = op.create_xml()
-            if xml:
-                self.ci.upload_xml(str(xml))
-                # Put "Build" operation as first element
-                if op.get_name().lower() == "build":
-                        out_files.insert(0, self.ci.xml_out)
-                else:
-                        out_files.append(self.ci.xml_out)
-            if op.get_name() == "configure":
+            is_build = op.get_name() in ("configure", "build")
+            if is_build and cache and cache_key is None:
+                    cache_key = self.cache_key(update)
+                    if cache_key:
+                            cached = cache.lookup(cache_key, self.ci.wdir)
+                    if cached is not None:
+                            self.ci.trace(1, "Nothing has changed since the last successful build, using cached configure and build result")
+            if op.get_name() == "test" and self.options.affected_only:
+                    self.select_affected(op, update)
+            out_file = None
+            if is_build and cached is not None:
+                    # Cache hit, skip the operation
+                    fname = cached.get(self.op_key(op))
+                    if fname:
+                            self.ci.trace(1, "  using cached result of %s" % (op.get_info()))
+                            cache.restore(fname, self.ci.xml_out)
+                            out_file = self.ci.xml_out
+            else:
+                    op.execute()
+                    xml = op.create_xml()
+                    if xml:
+                            self.ci.upload_xml(xml)
+                            out_file = self.ci.xml_out
+                            if is_build:
+                                    built[self.op_key(op)] = out_file
+                    op.cleanup()
+            if out_file:
+                self._add_output(op, out_file, out_files, upload)
+            if op.get_name() == "update":
+                    # The working copy revision may have changed
+                    self.wc_rev = None
+                    if op.head:
+                            update = op
+            if is_build and cached is not None:
+                    pass
+            elif op.get_name() == "configure":
                     if not op.success():
                             fatal_err = True
                             self.ci.trace(1, "  configure failed..!")
@@ -1916,65 +4249,209 @@ class Submission:
                     if fatal_err:
                             self.ci.trace(1, "Scenario is stopping due to fatal error")
                             break
+            if op.get_name() not in ("configure", "build") or op.success():
+                    self.journal.add_done(self.op_key(op), out_file)
             idx = idx + 1
 
-        self.ci.no_upload = no_upload
+        if cache_key and cached is None and built and not fatal_err:
+                cache.store(cache_key, built, self.ci.wdir)
 
-        # Create script to upload manually
-        # UPLOAD.BAT
-        fname = os.path.join(self.tmpdirname, "UPLOAD.BAT")
-        f = open(fname, "w")
-        for fname in out_files:
-                f.write("curl -T \"%s\" %s\r\n" % (fname, self.ci.submit_url))
-        f.close()
+    def _op_success(self, op):
+        if op.disabled:
+                return True
+        if op.get_name() == "testitem":
+                return op.exit_code() == 0
+        return op.success()
 
+    def _run_op(self, op, done):
+        ok = False
+        try:
+                op.execute()
+                ok = self._op_success(op)
+        finally:
+                # Also when CCDash.err_exit() is called
+                done.put((op, ok))
 
-        # Merge all files
-        if False:
-                # This doesn't work because CDash expects a Build submission first,
-                # and other items as separate submissions
-                self.ci.trace(1, "Merging and uploading..")
-                self.ci.xml_out = self.tmpdirname + ".xml"
-                self.ci.merge_files(out_files)
-        elif not self.ci.no_upload:
-                self.ci.trace(1, "Uploading files..")
-                self.ci.xml_out = os.path.join(self.tmpdirname, "tmp.xml")
-                for fname in out_files:
-                        f = open(fname, "rb")
-                        data = f.read()
-                        f.close()
-                        self.ci.upload_xml(data)
-        else:
-                self.ci.trace(1, "Not uploading (disabled by cmdline). You can upload manually")
+    def execute_graph(self, upload, out_files):
+        """\
+        Execute the operations as dependency graph (see 'depends' in
+        create_from_xml()). Each operation is started as soon as the
+        operations it depends on have succeeded, running up to 'jobs' of
+        them at a time. When an operation fails, only the operations which
+        depend on it are skipped, and skipped tests are reported as not
+        run. The tests are submitted together once they are all done.
+        With --affected-only, no test is started before the update is done.
 
-def cmd_scenario(options, args):
-    if len(args) != 2:
-        sys.stderr.write("Error: need exactly one scenario file argument\n")
-        return 1
+        """
+        import Queue
+        import threading
+
+        nodes = [op for op in self.ops if op is not self.test]
+        if self.test:
+                self.test.start()
+                nodes.extend(self.test._schedule(self.ci.get_history()))
+        jobs = max(1, self.ci.jobs)
+        state = {}              # Operation vs True if it has succeeded
+        done = Queue.Queue()
+        running = 0
+        update = None
+        affected_done = False
+        updates = [op for op in nodes if op.get_name() == "update"]
+        resumed = set()         # Operations done in the previous run
+        while nodes or running:
+            # Skip the operations which can't be run anymore
+            changed = True
+            while changed:
+                changed = False
+                for op in list(nodes):
+                    failed = [d for d in self.deps[op] if state.get(d) is False]
+                    if failed:
+                        self.ci.trace(1, "  skipping %s, %s has failed" % \
+                                         (op.get_info(), failed[0].get_info()))
+                        if op.get_name() == "testitem":
+                            op.set_notrun("%s has failed" % (failed[0].get_info()))
+                        nodes.remove(op)
+                        state[op] = False
+                        changed = True
+            # Start the operations which are ready
+            n_resumed = len(resumed)
+            for op in list(nodes):
+                if running >= jobs:
+                    break
+                if [d for d in self.deps[op] if not state.get(d)]:
+                    continue
+                if self.options.resume and op.get_name() != "testitem" and \
+                   not [d for d in self.deps[op] if d not in resumed] and \
+                   self._resume_op(op, out_files, upload):
+                    nodes.remove(op)
+                    state[op] = True
+                    resumed.add(op)
+                    continue
+                if op.get_name() == "testitem" and \
+                   self.options.affected_only and not affected_done:
+                    # The changed paths are only known once the update
+                    # is done, even if the tests don't depend on it
+                    if [u for u in updates if u not in state]:
+                        continue
+                    self.select_affected(self.test, update)
+                    affected_done = True
+                nodes.remove(op)
+                running = running + 1
+                th = threading.Thread(target=self._run_op, args=(op, done))
+                th.start()
+            if not running:
+                if len(resumed) > n_resumed:
+                    continue
+                break
+
+            op, ok = done.get()
+            running = running - 1
+            state[op] = ok
+            if not ok:
+                self.ci.trace(1, "  %s failed..!" % (op.get_info()))
+            if op.get_name() == "testitem":
+                continue
+            if op.get_name() == "update":
+                # The working copy revision may have changed
+                self.wc_rev = None
+                if op.head:
+                    update = op
+            self.ci.xml_out = os.path.join(self.tmpdirname, "%03d-%s.xml" % \
+                                           (self.ops.index(op) + 1, op.get_name()))
+            xml = op.create_xml()
+            out_file = None
+            if xml:
+                self.ci.upload_xml(xml)
+                out_file = self.ci.xml_out
+                self._add_output(op, out_file, out_files, upload)
+            op.cleanup()
+            if ok:
+                self.journal.add_done(self.op_key(op), out_file)
+
+        if self.test:
+            self.test.finish()
+            self.ci.xml_out = os.path.join(self.tmpdirname, "%03d-%s.xml" % \
+                                           (self.ops.index(self.test) + 1, "test"))
+            xml = self.test.create_xml()
+            if xml:
+                self.ci.upload_xml(xml)
+                self._add_output(self.test, self.ci.xml_out, out_files, upload)
+
+def load_scenario(options, filename):
+    """\
+    Parse the scenario file, and take the settings which are not specified
+    in the command line from it. Returns the <Scenario> node, or None on
+    error.
+
+    """
+    import xml.dom.minidom
 
-    doc = xml.dom.minidom.parse(args[1])
+    doc = xml.dom.minidom.parse(filename)
     scenario = doc.documentElement
     if scenario.nodeName.lower() != "scenario":
         sys.stderr.write("Error: missing <Scenario> root node\n")
-        return 1
+        return None
 
     if not options.site_name:
         options.site_name = scenario.getAttribute("site")
     if not options.site_name:
         sys.stderr.write("Error: site name is not specified. You need to specify either in scenario file or in cmdline.\n")
-        return 1
+        return None
 
     if not options.url:
         options.url = scenario.getAttribute("url")
     if not options.url:
         sys.stderr.write("Error: URL is not specified. You need to specify either in scenario file or in cmdline.\n")
-        return 1
+        return None
 
     if not options.wdir:
         options.wdir = scenario.getAttribute("wdir")
     if not options.wdir:
         sys.stderr.write("Error: wdir is not specified. You need to specify working directory either in scenario file or in cmdline.\n")
+        return None
+
+    if not options.timeout and scenario.getAttribute("timeout"):
+        options.timeout = int(scenario.getAttribute("timeout"))
+
+    if options.submit_jobs > 1 and not options.isolate_dir:
+        sys.stderr.write("Error: --submit-jobs needs --isolate-dir, so " + \
+                         "that the submissions don't share the working " + \
+                         "directory\n")
+        return None
+
+    return scenario
+
+
+def cmd_scenario(options, args):
+    if len(args) != 2:
+        sys.stderr.write("Error: need exactly one scenario file argument\n")
+        return 1
+
+    scenario = load_scenario(options, args[1])
+    if scenario is None:
+        return 1
+    return run_scenario(options, scenario)
+
+
+def run_scenario(options, scenario):
+    """\
+    Execute the submissions of the scenario (see load_scenario()), with a
+    new build stamp.
+
+    """
+    subs = create_submissions(options, scenario)
+    if subs is None:
         return 1
+    return run_submissions(options, subs)
+
+
+def create_submissions(options, scenario):
+    """\
+    Create the submissions of the scenario (see load_scenario()), with a
+    new build stamp. Returns the list of Submission's, or None on error.
+
+    """
+    import xml.dom
 
     options.timestamp = time.strftime("%Y%m%d-%H%M-%S", time.localtime())
 
@@ -1985,15 +4462,181 @@ def cmd_scenario(options, args):
             continue
         sub = Submission.create_from_xml(options, subnode)
         if not sub:
-            return 1
+            return None
+        for other in subs:
+            if sub.src_wdir and sub.ci.wdir == other.ci.wdir:
+                sys.stderr.write("Error: submissions '%s' and '%s' would " \
+                                 "share the working directory copy\n" % \
+                                 (other.ci.build_name, sub.ci.build_name))
+                return None
         subs.append(sub)
+    return subs
 
-    # Execute them!
-    for submit in subs:
-        # Execute all tests
-        submit.execute()
+
+def run_submissions(options, subs):
+    """\
+    Execute the submissions created by create_submissions(). Returns
+    non-zero if any of them has failed.
+
+    """
+    jobs = min(options.submit_jobs, len(subs))
+    if jobs > 1:
+        rc = _execute_submissions(subs, jobs)
+    else:
+        rc = 0
+        for submit in subs:
+            # Execute all tests
+            if submit.execute():
+                rc = 1
 
     sys.stdout.write("Done\n")
+    return rc
+
+
+def cmd_watch(options, args):
+    """\
+    Watch the repository of the scenario working directory, and execute
+    the scenario whenever there are new revisions. The scenario is only
+    parsed once, and its submissions are reset for each run. After a new
+    revision is seen, the scenario is started once no more commits have
+    arrived for 'settle' seconds, so that a burst of commits is built
+    together. A revision whose run fails is tried again on the next polls,
+    up to 'retries' times, and then skipped.
+
+    """
+    try:
+        import pysvn
+    except ImportError:
+        sys.stderr.write("Error: watch operation needs pysvn module\n")
+        return 1
+
+    if len(args) != 2:
+        sys.stderr.write("Error: need exactly one scenario file argument\n")
+        return 1
+
+    scenario = load_scenario(options, args[1])
+    if scenario is None:
+        return 1
+    subs = create_submissions(options, scenario)
+    if subs is None:
+        return 1
+
+    # Note: create_ccdash() clears the options
+    ccdash = create_ccdash(copy.copy(options), check_options=False)
+    if ccdash is None:
+        return 1
+    try:
+        watcher = SvnWatcher(ccdash, options.wdir)
+    except pysvn.ClientError, e:
+        sys.stderr.write("Error: %s\n" % (str(e)))
+        return 1
+
+    last = watcher.base
+    failed_rev = None                   # Last revision which has failed
+    failures = 0                        # Number of its failed runs
+    ccdash.trace(1, "Watching %s (%s at revision %d), polling every %d " \
+                    "seconds.." % (watcher.url, options.wdir, last,
+                                   options.watch_interval))
+    try:
+        while True:
+            try:
+                head = watcher.head()
+                if head != last:
+                    # Wait until the commits stop coming
+                    ccdash.trace(1, "New revision %d, waiting for more " \
+                                    "commits.." % (head))
+                    while True:
+                        time.sleep(options.watch_settle)
+                        rev = watcher.head()
+                        if rev == head:
+                            break
+                        head = rev
+                    ccdash.trace(1, "Running scenario for revision %d (was " \
+                                    "%d)" % (head, last))
+                    timestamp = time.strftime("%Y%m%d-%H%M-%S",
+                                              time.localtime())
+                    for submit in subs:
+                        submit.reset(timestamp)
+                    try:
+                        rc = run_submissions(options, subs)
+                    except SystemExit:
+                        # The error has been printed by CCDash.err_exit()
+                        rc = 1
+                    except Exception, e:
+                        ccdash.trace(-1, "Error: %s" % (str(e)))
+                        rc = 1
+                    if not rc:
+                        last = head
+                    else:
+                        if head != failed_rev:
+                            failed_rev = head
+                            failures = 0
+                        failures = failures + 1
+                        if failures <= options.watch_retries:
+                            # Retry the revision on the next poll
+                            ccdash.trace(-1, "Warning: scenario run for " \
+                                             "revision %d has failed" % \
+                                             (head))
+                        else:
+                            ccdash.trace(-1, "Warning: scenario run for " \
+                                             "revision %d has failed %d " \
+                                             "times, skipping it" % \
+                                             (head, failures))
+                            last = head
+            except pysvn.ClientError, e:
+                ccdash.trace(-1, "Warning: %s" % (str(e)))
+            time.sleep(options.watch_interval)
+    except KeyboardInterrupt:
+        ccdash.trace(1, "Stopped")
+    return 0
+
+
+def _submission_worker(subs, failed):
+    import Queue
+
+    while True:
+        try:
+            submit = subs.get_nowait()
+        except Queue.Empty:
+            break
+        try:
+            if submit.execute():
+                failed.append(submit)
+        except SystemExit:
+            # From CCDash.err_exit()
+            failed.append(submit)
+
+
+def _execute_submissions(subs, jobs):
+    """\
+    Execute the submissions, up to 'jobs' of them at a time. Their trace
+    messages are prefixed with the build name. Returns non-zero if any of
+    them has failed.
+
+    """
+    import Queue
+    import threading
+
+    sys.stdout.write("Running %d submissions, %d at a time..\n" % \
+                     (len(subs), jobs))
+    queue = Queue.Queue()
+    for submit in subs:
+        submit.ci.trace_prefix = "[%s] " % (submit.ci.build_name)
+        queue.put(submit)
+    failed = []
+    threads = []
+    for i in range(jobs):
+        th = threading.Thread(target=_submission_worker, args=(queue, failed))
+        th.start()
+        threads.append(th)
+    for th in threads:
+        th.join()
+    for submit in failed:
+        sys.stderr.write("Error: submission '%s' has failed\n" % \
+                         (submit.ci.build_name))
+    if failed:
+        return 1
+    return 0
 
 #
 # main()
@@ -2018,6 +4661,10 @@ operations:
   build BUILDCMD        Perform build operation as specified by BUILDCMD,
                         and upload the result to CDash.
 
+  parse-log FILE [BUILDCMD]
+                        Parse existing build log FILE (of the BUILDCMD) and
+                        upload the result to CDash as build operation.
+
   test NAME CMDLINE     Perform a unit test operation as specified by CMDLINE,
                         and upload the result to CDash server as test entry
                         NAME.
@@ -2029,6 +4676,17 @@ operations:
 
   scenario FILE         Execute XML scenario in FILE
 
+  watch FILE            Keep running, and execute XML scenario in FILE
+                        whenever there are new revisions in the repository
+                        of its working directory.
+
+  drain                 Upload the submissions which have been kept in the
+                        spool because they could not be uploaded before.
+
+  history [NAME]        Show the durations of the recorded runs of test
+                        NAME, or all tests, optionally filtered by the site
+                        and build name.
+
 Sample session:
   $ ccdash.py build "make clean && make dep && make all" \\
       -w /path/to/project \\
@@ -2067,6 +4725,43 @@ Sample session:
                      help="Do not perform update on local copy")
     parser.add_option_group(group)
 
+    group = OptionGroup(parser, "Scenario options")
+    group.add_option("", "--isolate-dir", dest="isolate_dir", default="",
+                     help="Run each <Submit> of the scenario in its own " + \
+                          "copy of the working directory, in a " + \
+                          "subdirectory of ISOLATE_DIR named after the " + \
+                          "build name. The copy is made on the first run " +\
+                          "and kept for the next runs.")
+    group.add_option("", "--submit-jobs", type="int", dest="submit_jobs",
+                     default=1,
+                     help="Run up to SUBMIT_JOBS <Submit> blocks of the " + \
+                          "scenario at the same time. Requires " + \
+                          "--isolate-dir.")
+    group.add_option("", "--resume", action="store_true", dest="resume",
+                     default=False,
+                     help="Resume the interrupted run of the scenario: " + \
+                          "skip the operations which have been done with " +\
+                          "the same settings, and submit the results with " +\
+                          "the build stamp of that run.")
+    group.add_option("", "--watch-interval", type="int",
+                     dest="watch_interval", default=WATCH_INTERVAL,
+                     help="In watch operation, check the repository for " +\
+                          "new revisions every WATCH_INTERVAL seconds. " + \
+                          "Default is %d seconds." % (WATCH_INTERVAL))
+    group.add_option("", "--watch-settle", type="int",
+                     dest="watch_settle", default=WATCH_SETTLE,
+                     help="In watch operation, wait until there are no " + \
+                          "new commits for WATCH_SETTLE seconds before " + \
+                          "running the scenario. Default is %d seconds." % \
+                          (WATCH_SETTLE))
+    group.add_option("", "--watch-retries", type="int",
+                     dest="watch_retries", default=WATCH_RETRIES,
+                     help="In watch operation, run the scenario again " + \
+                          "up to WATCH_RETRIES times if it fails for a " + \
+                          "revision, before skipping the revision. " + \
+                          "Default is %d." % (WATCH_RETRIES))
+    parser.add_option_group(group)
+
     group = OptionGroup(parser, "Build options")
     group.add_option("", "--build-log", action="store_true", default=False,
                      dest="build_log",
@@ -2075,6 +4770,30 @@ Sample session:
     group.add_option("", "--build-log-file", dest="buildlogfile", default="",
                      help="Store the plain-text version of build output " + \
                           "logs to this file.")
+    group.add_option("", "--build-cache", action="store_const",
+                     dest="build_cache_dir", const=BUILD_CACHE_DIR,
+                     default="",
+                     help="In scenario, skip configure and build if the " + \
+                          "source revision, FileWrite contents, and the " + \
+                          "commands are the same as in the last " + \
+                          "successful build in the working directory, and"+\
+                          " submit the previous result instead. The " + \
+                          "results are kept in " + \
+                          BUILD_CACHE_DIR)
+    group.add_option("", "--build-cache-dir", dest="build_cache_dir",
+                     help="Same as --build-cache, but keep the results " + \
+                          "in BUILD_CACHE_DIR.")
+    group.add_option("", "--max-build-msgs", type="int",
+                     dest="max_build_msgs", default=-1,
+                     help="Limit the number of distinct warnings and " + \
+                          "errors in build submission to MAX_BUILD_MSGS." + \
+                          " Repeats of the same message are counted in " + \
+                          "its RepeatCount. Default is no limit.")
+    group.add_option("", "--parse-jobs", type="int", dest="parse_jobs",
+                     default=0,
+                     help="Number of processes to parse the build log " + \
+                          "with in parse-log operation. Default (0) is " + \
+                          "the number of CPUs.")
     parser.add_option_group(group)
 
     group = OptionGroup(parser, "Test options")
@@ -2082,6 +4801,53 @@ Sample session:
                      help="Set the test timeout to T1 seconds. Default " +\
                           "is %d seconds (%d minutes)." % \
                           (TEST_TIMEOUT, TEST_TIMEOUT/60))
+    group.add_option("", "--timeout", type="int", dest="timeout", default=0,
+                     help="Set the default timeout of the configure, " + \
+                          "build, and test operations in scenario to " + \
+                          "TIMEOUT seconds. This can also be set with " + \
+                          "'timeout' attribute of <Scenario>, and for " + \
+                          "each operation with its 'timeout' attribute. " +\
+                          "Without it only tests have a timeout (--t1).")
+    group.add_option("-j", "--jobs", type="int", dest="jobs", default=0,
+                     help="Run up to JOBS tests at the same time. This " + \
+                          "can also be set with 'jobs' attribute of " + \
+                          "<Submit> in scenario file, which is used if " + \
+                          "this option is not given. Default is 1.")
+    group.add_option("", "--affected-only", action="store_true",
+                     dest="affected_only", default=False,
+                     help="In scenario, only run the tests with 'paths' " + \
+                          "attribute if the update changes any of the " + \
+                          "paths. The other tests are reported as not run.")
+    group.add_option("", "--history-db", dest="history_db",
+                     default=HISTORY_DB,
+                     help="Record the test results in HISTORY_DB, which " + \
+                          "is used to run the longest tests first and to " +\
+                          "detect performance regressions. Set " + \
+                          "to empty to disable. Default is " + HISTORY_DB)
+    group.add_option("", "--adaptive-timeout", action="store_true",
+                     dest="adaptive_timeout", default=False,
+                     help="Lower the timeout of tests which don't have " + \
+                          "'timeout' attribute to %d times " % \
+                          (ADAPTIVE_TIMEOUT_FACTOR) + \
+                          "the 99th percentile of their duration in the " + \
+                          "test history, but at least %d seconds." % \
+                          (ADAPTIVE_TIMEOUT_MIN))
+    parser.add_option_group(group)
+
+    group = OptionGroup(parser, "Upload options")
+    group.add_option("", "--spool-dir", dest="spool_dir", default=SPOOL_DIR,
+                     help="Keep the submissions which could not be " + \
+                          "uploaded in SPOOL_DIR, to be sent later with " + \
+                          "drain operation. Default is " + SPOOL_DIR)
+    group.add_option("", "--upload-retries", type="int",
+                     dest="upload_retries", default=UPLOAD_RETRIES,
+                     help="Retry failed uploads UPLOAD_RETRIES times, " + \
+                          "doubling the delay between the attempts. " + \
+                          "Default is %d." % (UPLOAD_RETRIES))
+    group.add_option("", "--drain-jobs", type="int", dest="drain_jobs",
+                     default=DRAIN_JOBS,
+                     help="Number of batches to upload concurrently in " + \
+                          "drain operation. Default is %d." % (DRAIN_JOBS))
     parser.add_option_group(group)
 
     group = OptionGroup(parser, "General options")
@@ -2131,6 +4897,8 @@ Sample session:
         rc = 1
     elif args[0]=="build":
         rc = cmd_build(options, args)
+    elif args[0]=="parse-log":
+        rc = cmd_parse_log(options, args)
     elif args[0]=="test":
         rc = cmd_test(options, args)
     elif args[0]=="status":
@@ -2145,6 +4913,12 @@ Sample session:
                rc = cmd_upload(options, args)
     elif args[0]=="scenario":
            rc = cmd_scenario(options, args)
+    elif args[0]=="watch":
+        rc = cmd_watch(options, args)
+    elif args[0]=="drain":
+        rc = cmd_drain(options)
+    elif args[0]=="history":
+        rc = cmd_history(options, args)
     else:
         print "Error: unknown command '" + args[0] + "'"
         parser.print_help()
@@ -0,0 +1,126 @@
+#!/usr/bin/python
+#
+# Benchmark the parsing of build output by Build._parse_output() on
+# synthetic multi-million line build logs.
+#
+# Usage: python bench_build_parse.py [--lines N] [OTHER_CCDASH_PY]
+#
+# Two logs of N lines (default 2000000) are parsed: a typical gcc build log
+# with 5% warning and error lines, and a log where most lines contain a
+# colon without being messages (e.g. "make[1]: Entering directory"), which
+# is the worst case for the parser. If OTHER_CCDASH_PY is given (e.g. an
+# older revision extracted with "git show REV:ccdash/ccdash.py >
+# /tmp/old.py"), it is measured too, and the parsed messages of both
+# versions are compared.
+#
+
+import imp
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                ".."))
+import ccdash
+
+LINES = 2000000
+
+# Compiler messages of all the kinds recognized by the parser
+MSG_LINES = [
+    "../src/pj/os_core_unix.c:%d: warning: unused variable 'rc'",
+    "../src/pjsip/sip_msg.c:%d: error: 'x' undeclared",
+    "..\\src\\pj\\ioqueue_winnt.c(%d) : warning C4244: conversion",
+    "..\\src\\pjsua-lib\\pjsua_call.c(%d) : error C2065: 'y' : undeclared",
+    "LINK : fatal error LNK1104: cannot open file 'pjlib.lib' (%d)",
+    "\\pjlib\\src\\pj\\file_io.cpp:%d: undefined identifier 'z'",
+    "../src/pj/log.c:%d: note: declared here",
+]
+
+# Lines which are not messages
+PLAIN_LINES = [
+    "gcc -c -Wall -O2 -o output/pjlib/os_core_unix.o ../src/pj/os_core_unix.c",
+    "ar rv ../lib/libpj-x86_64-unknown-linux-gnu.a output/pjlib/*.o",
+    "In file included from ../include/pj/types.h, from ../src/pj/log.c",
+]
+COLON_LINES = [
+    "make[%d]: Entering directory `/home/build/pjproject/pjlib/build'",
+    "ar: creating ../lib/libpjsip-x86_64-unknown-linux-gnu.a (%d)",
+    "Compiling: pjsip/src/pjsip/sip_transport_%d.c",
+    "  Time: 12:00:%d, target: all",
+]
+
+
+def make_log(fname, n_lines, msg_every, colon_every):
+    f = open(fname, "w")
+    for i in range(n_lines):
+        if i % msg_every == 0:
+            # Each message is distinct, so no repeats are merged
+            line = MSG_LINES[(i / msg_every) % len(MSG_LINES)] % (i)
+        elif i % colon_every == 0:
+            line = COLON_LINES[i % len(COLON_LINES)] % (i % 10)
+        else:
+            line = PLAIN_LINES[i % len(PLAIN_LINES)]
+        f.write(line + "\n")
+    f.close()
+
+
+def parse(mod, fname):
+    """\
+    Feed the log to Build._parse_output() the same way as exec_cmd() does.
+    Returns (elapsed, messages).
+
+    """
+    build = mod.Build(None, "")
+    f = open(fname, "rb")
+    t0 = time.time()
+    line_num = 0
+    for line in f:
+        line_num = line_num + 1
+        build._parse_output(line.replace("\r", "").rstrip("\n"), line_num)
+    elapsed = time.time() - t0
+    f.close()
+    msgs = [(w.type, w.log_line_num, w.file, w.line) for w in build.warn_err]
+    return elapsed, msgs
+
+
+def main(args):
+    n_lines = LINES
+    other = None
+    i = 1
+    while i < len(args):
+        if args[i] == "--lines":
+            n_lines = int(args[i+1])
+            i = i + 2
+        else:
+            other = imp.load_source("ccdash_other", args[i])
+            i = i + 1
+
+    logs = [("gcc log, 5% messages", 20, 10),
+            ("colon heavy log", 20, 2)]
+    fd, fname = tempfile.mkstemp(suffix=".log")
+    os.close(fd)
+    try:
+        sys.stdout.write("%-24s %10s %10s %10s" % \
+                         ("input", "lines", "msgs", "new s"))
+        if other:
+            sys.stdout.write(" %10s" % ("other s"))
+        sys.stdout.write("\n")
+        for name, msg_every, colon_every in logs:
+            make_log(fname, n_lines, msg_every, colon_every)
+            elapsed, msgs = parse(ccdash, fname)
+            sys.stdout.write("%-24s %10d %10d %10.3f" % \
+                             (name, n_lines, len(msgs), elapsed))
+            if other:
+                other_elapsed, other_msgs = parse(other, fname)
+                sys.stdout.write(" %10.3f" % (other_elapsed))
+                if msgs != other_msgs:
+                    sys.stdout.write("  MESSAGES DIFFER")
+            sys.stdout.write("\n")
+    finally:
+        os.remove(fname)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
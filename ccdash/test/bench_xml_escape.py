@@ -0,0 +1,105 @@
+#!/usr/bin/python
+#
+# Micro-benchmark of xml_escape() on pjsua-like logs.
+#
+# Usage: python bench_xml_escape.py [--log FILE] [OTHER_CCDASH_PY]
+#
+# By default synthetic logs of LOG_SIZE bytes are used: with XML special
+# characters, with nothing to escape, and with many latin-1 characters.
+# With --log, the content of FILE (e.g. a real pjsua log) is used instead.
+# If OTHER_CCDASH_PY is given (e.g. an older revision extracted with
+# "git show REV:ccdash/ccdash.py > /tmp/old.py"), it is measured too, and
+# the output of both versions is compared.
+#
+
+import imp
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                ".."))
+import ccdash
+
+LOG_SIZE = 2 * 1024 * 1024
+REPEAT = 3
+
+# pjsua log lines, with SIP messages containing '<' and '>'
+PJSUA_LINES = [
+    "09:41:06.213 pjsua_core.c  .TX 512 bytes Request msg INVITE/cseq=1 "
+    "(tdta0x8) to UDP 127.0.0.1:5060:\n",
+    "INVITE sip:alice@127.0.0.1 SIP/2.0\n",
+    "From: <sip:bob@127.0.0.1>;tag=abc & co\n",
+    "To: <sip:alice@127.0.0.1>\n",
+    "09:41:06.214 pjsua_call.c  .Call 0 state changed to CALLING\n",
+    "09:41:06.215  sip_endpoint.c  Processing incoming message: Response "
+    "msg 180/INVITE/cseq=1 (rdata0x9)\n",
+]
+
+# Same lines without anything to escape
+PLAIN_LINES = [
+    "09:41:06.213 pjsua_core.c  .TX 512 bytes Request msg INVITE/cseq=1 "
+    "(tdta0x8) to UDP 127.0.0.1:5060:\n",
+    "09:41:06.214 pjsua_call.c  .Call 0 state changed to CALLING\n",
+    "09:41:06.215  sip_endpoint.c  Processing incoming message: Response "
+    "msg 180/INVITE/cseq=1 (rdata0x9)\n",
+]
+
+# Lines with latin-1 characters, e.g. from display names
+LATIN1_LINES = [
+    "09:41:06.213 pjsua_app.c  Buddy \"J\xfcrgen M\xfcller\" is online\n",
+    "From: \"Fran\xe7ois\" <sip:francois@127.0.0.1>\n",
+    "09:41:06.214 pjsua_pres.c  Presence of Se\xf1or Pe\xf1a: \xab busy \xbb\n",
+]
+
+
+def make_log(lines, size):
+    chunk = "".join(lines)
+    return (chunk * (size / len(chunk) + 1))[:size]
+
+
+def measure(func, txt):
+    best = None
+    for i in range(REPEAT):
+        t0 = time.time()
+        func(txt)
+        elapsed = time.time() - t0
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def main(args):
+    logs = []
+    other = None
+    i = 1
+    while i < len(args):
+        if args[i] == "--log":
+            logs.append((os.path.basename(args[i+1]),
+                         open(args[i+1], "rb").read()))
+            i = i + 2
+        else:
+            other = imp.load_source("ccdash_other", args[i])
+            i = i + 1
+    if not logs:
+        logs = [("log with <, >, &", make_log(PJSUA_LINES, LOG_SIZE)),
+                ("log with no escapes", make_log(PLAIN_LINES, LOG_SIZE)),
+                ("latin-1 heavy log", make_log(LATIN1_LINES, LOG_SIZE))]
+
+    sys.stdout.write("%-24s %10s %10s" % ("input", "bytes", "new s"))
+    if other:
+        sys.stdout.write(" %10s" % ("other s"))
+    sys.stdout.write("\n")
+    for name, txt in logs:
+        sys.stdout.write("%-24s %10d %10.3f" % \
+                         (name, len(txt), measure(ccdash.xml_escape, txt)))
+        if other:
+            sys.stdout.write(" %10.3f" % (measure(other.xml_escape, txt)))
+            if ccdash.xml_escape(txt) != other.xml_escape(txt):
+                sys.stdout.write("  OUTPUT DIFFERS")
+        sys.stdout.write("\n")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
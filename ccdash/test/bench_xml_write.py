@@ -0,0 +1,125 @@
+#!/usr/bin/python
+#
+# Benchmark the serialization of Node trees, to check that the time grows
+# linearly with the number of nodes and with the size of the bodies.
+#
+# Usage: python bench_xml_write.py [OTHER_CCDASH_PY]
+#
+# If OTHER_CCDASH_PY is given (e.g. an older revision extracted with
+# "git show REV:ccdash/ccdash.py > /tmp/old.py"), it is measured too, and
+# the output of both versions is compared.
+#
+
+import imp
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                ".."))
+import ccdash
+
+NODE_COUNTS = [1000, 4000, 16000, 64000]
+BODY_SIZES = [1024, 64 * 1024, 1024 * 1024, 4 * 1024 * 1024]
+REPEAT = 3
+
+
+class NullWriter:
+    def __init__(self):
+        self.size = 0
+        self.chunks = None      # Collect the output if this is a list
+
+    def write(self, s):
+        self.size = self.size + len(s)
+        if self.chunks is not None:
+            self.chunks.append(s)
+
+
+def create_tree(mod, n_nodes, body_size):
+    """\
+    Create <Site><Testing> tree with 'n_nodes' nodes in total, like test
+    submission, with one big <Log> body of 'body_size' bytes.
+
+    """
+    line = "12:00:00.000 sip_endpoint.c  Request msg INVITE/cseq=1 <sip:a@b>\n"
+    site = mod.Node("Site", attrs={"Name": "bench", "BuildName": "b"})
+    testing = mod.Node("Testing")
+    site.insertNode(testing)
+    n = 2
+    i = 0
+    while n < n_nodes:
+        t = mod.Node("Test", attrs={"Status": "passed"})
+        t.insertNode(mod.Node("Name", body="test %d" % (i)))
+        t.insertNode(mod.Node("Path", body="./pjlib & <more>"))
+        testing.insertNode(t)
+        n = n + 3
+        i = i + 1
+    log = (line * (body_size / len(line) + 1))[:body_size]
+    testing.insertNode(mod.Node("Log", body=log))
+    return site
+
+
+def write_tree(mod, tree, f):
+    if hasattr(mod.Node, "write"):
+        tree.write(f)
+    else:
+        # Versions before the streaming writer
+        f.write(str(tree))
+
+
+def measure(mod, tree):
+    best = None
+    for i in range(REPEAT):
+        w = NullWriter()
+        t0 = time.time()
+        write_tree(mod, tree, w)
+        elapsed = time.time() - t0
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def output(mod, tree):
+    w = NullWriter()
+    w.chunks = []
+    write_tree(mod, tree, w)
+    return "".join(w.chunks)
+
+
+def run(mods, title, cases):
+    sys.stdout.write("\n%s\n" % (title))
+    sys.stdout.write("%10s %10s" % ("nodes", "body"))
+    for name, mod in mods:
+        sys.stdout.write(" %12s %12s" % (name + " s", "us/unit"))
+    sys.stdout.write("\n")
+    for n_nodes, body_size, units in cases:
+        sys.stdout.write("%10d %10d" % (n_nodes, body_size))
+        outs = []
+        for name, mod in mods:
+            tree = create_tree(mod, n_nodes, body_size)
+            elapsed = measure(mod, tree)
+            sys.stdout.write(" %12.3f %12.3f" % \
+                             (elapsed, elapsed * 1000000 / units))
+            if len(mods) > 1:
+                outs.append(output(mod, tree))
+        if outs and outs[0] != outs[1]:
+            sys.stdout.write("  OUTPUT DIFFERS")
+        sys.stdout.write("\n")
+
+
+def main(args):
+    mods = [("new", ccdash)]
+    if len(args) > 1:
+        mods.append(("other", imp.load_source("ccdash_other", args[1])))
+
+    # Time per node (us/unit) should stay about the same
+    run(mods, "Node count (1 KB log):",
+        [(n, 1024, n) for n in NODE_COUNTS])
+    # Time per KB of body (us/unit) should stay about the same
+    run(mods, "Body size (1000 nodes):",
+        [(1000, size, size / 1024) for size in BODY_SIZES])
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,204 @@
+#!/usr/bin/python
+#
+# Test HttpUploader against a local HTTP server: PUT of a file, reuse of the
+# connection, retry when the server has closed the idle connection, and the
+# reporting of HTTP and connection errors. Also test that only temporary
+# failures are put in the spool, that drain skips rejected files, and that
+# a rejected submission fails.
+#
+# Usage: python http_upload.py
+#
+
+import BaseHTTPServer
+import os
+import shutil
+import socket
+import SocketServer
+import sys
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                ".."))
+import ccdash
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # Keep the connection alive between requests
+    protocol_version = "HTTP/1.1"
+
+    def do_PUT(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        self.server.requests.append((self.path, body, self.client_address))
+        if self.path.startswith("/error"):
+            code = int(self.path[len("/error"):])
+        else:
+            code = 200
+        self.send_response(code)
+        self.send_header("Content-Length", "2")
+        self.end_headers()
+        self.wfile.write("ok")
+        if self.path.startswith("/close"):
+            # Close the connection after the response, like a server
+            # dropping an idle connection
+            self.close_connection = 1
+
+    def log_message(self, format, *args):
+        pass
+
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    # Serve each connection in its own thread, since the connections of
+    # the uploaders are kept alive
+    daemon_threads = True
+
+
+def start_server():
+    server = Server(("127.0.0.1", 0), Handler)
+    server.requests = []
+    th = threading.Thread(target=server.serve_forever)
+    th.setDaemon(True)
+    th.start()
+    return server
+
+
+def closed_port():
+    s = socket.socket()
+    s.bind(("127.0.0.1", 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+failures = 0
+
+def check(name, cond):
+    global failures
+    if cond:
+        sys.stdout.write("PASS: %s\n" % (name))
+    else:
+        sys.stdout.write("FAIL: %s\n" % (name))
+        failures = failures + 1
+
+
+def check_spool(server, base, fname):
+    spool_dir = tempfile.mkdtemp()
+    ci = ccdash.CCDash(base + "/error404", "site", "build", "stamp", ".")
+    try:
+        ci.spool_dir = spool_dir
+        ci.upload_retries = 0
+        spool = ci.get_spool()
+
+        # Rejected file is not spooled
+        ret = ci.submit_file(fname)
+        check("HTTP 404 is not spooled",
+              ret is not None and ret.error() and \
+              not spool.has_batch("stamp"))
+
+        # Server error is spooled
+        ci.submit_url = base + "/error503"
+        ret = ci.submit_file(fname)
+        check("HTTP 503 is spooled",
+              ret is None and len(spool.files("stamp")) == 1)
+
+        # Drain sends the rest of the batch after a rejected file
+        shutil.rmtree(spool_dir)
+        spool.add("stamp", fname, base + "/error400")
+        spool.add("stamp", fname, base + "/submit.php")
+        n = len(server.requests)
+        check("drain with rejected file fails", spool.drain(1) == 1)
+        check("drain sends the file after the rejected one",
+              len(server.requests) == n+2 and \
+              server.requests[-1][0] == "/submit.php")
+        names = os.listdir(os.path.join(spool_dir, "stamp"))
+        names.sort()
+        check("rejected file is out of the batch",
+              spool.files("stamp") == [] and \
+              len([f for f in names if f.endswith(".rejected")]) == 1)
+        check("rejected file keeps its URL file",
+              len(names) == 2 and names[1] == names[0] + ".url")
+        n = len(server.requests)
+        check("rejected file is not sent again",
+              spool.drain(1) == 0 and len(server.requests) == n)
+
+        # Rejected submission fails the command
+        shutil.rmtree(spool_dir)
+        ci.submit_url = base + "/error400"
+        try:
+            ci.upload_xml("<Site/>")
+            exited = False
+        except SystemExit:
+            exited = True
+        check("rejected submission exits", exited)
+    finally:
+        if ci.uploader is not None:
+            ci.uploader.close()
+        shutil.rmtree(spool_dir, True)
+
+
+def main():
+    server = start_server()
+    base = "http://127.0.0.1:%d" % (server.server_address[1])
+
+    fd, fname = tempfile.mkstemp(suffix=".xml")
+    content = "<Site>" + "x" * 100000 + "</Site>\n"
+    os.write(fd, content)
+    os.close(fd)
+
+    up = ccdash.HttpUploader()
+    try:
+        # Upload
+        ret = up.put_file(fname, base + "/submit.php?project=Hello")
+        check("PUT succeeds", not ret.error() and ret.output == "ok")
+        path, body, addr1 = server.requests[-1]
+        check("PUT path and query", path == "/submit.php?project=Hello")
+        check("PUT body", body == content)
+
+        # Connection reuse
+        ret = up.put_file(fname, base + "/submit.php")
+        addr2 = server.requests[-1][2]
+        check("second PUT succeeds", not ret.error())
+        check("connection is reused", addr1 == addr2)
+
+        # The server closes the connection, the next upload reconnects
+        ret = up.put_file(fname, base + "/close")
+        check("PUT before close succeeds", not ret.error())
+        n = len(server.requests)
+        ret = up.put_file(fname, base + "/submit.php")
+        check("PUT after close succeeds", not ret.error())
+        check("PUT after close is sent once", len(server.requests) == n+1)
+        check("new connection after close",
+              server.requests[-1][2] != addr2)
+
+        # HTTP errors
+        ret = up.put_file(fname, base + "/error500")
+        check("HTTP 500 is error", ret.error() and ret.retcode == 500)
+        ret = up.put_file(fname, base + "/error404")
+        check("HTTP 404 is error", ret.error() and ret.retcode == 404)
+        ret = up.put_file(fname, base + "/submit.php")
+        check("PUT after HTTP error succeeds", not ret.error())
+
+        # Other errors
+        ret = up.put_file(fname, "http://127.0.0.1:%d/" % (closed_port()))
+        check("connection refused is error",
+              ret.error() and ret.retcode == 127)
+        ret = up.put_file(fname, "ftp://127.0.0.1/")
+        check("unsupported scheme is error", ret.error())
+        ret = up.put_file(fname + ".missing", base + "/submit.php")
+        check("missing file is error", ret.error())
+
+        check_spool(server, base, fname)
+    finally:
+        up.close()
+        server.shutdown()
+        os.remove(fname)
+
+    if failures:
+        sys.stdout.write("%d check(s) failed\n" % (failures))
+        return 1
+    sys.stdout.write("All checks passed\n")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())